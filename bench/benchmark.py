@@ -0,0 +1,304 @@
+# =============================
+# BENCHMARK DE CARGA CON GEMINI SIMULADO
+# =============================
+"""
+Simula muchos estudiantes haciendo sesiones completas de 10 preguntas contra
+/quiz (GET/POST), con un cliente Gemini falso en lugar de genai.Client.
+
+Cada escenario (combinación de estudiantes concurrentes y tamaño de cache)
+corre en un subproceso propio, porque main.py lee su configuración del
+entorno al importarse. Los resultados se guardan en bench/resultados/ y se
+comparan con la corrida anterior para detectar regresiones.
+
+Uso:
+    python bench/benchmark.py --estudiantes 10,50,100 --cache-local 20,100 \\
+        --latencia 1.5 --error 0.02 --cuota 0.05 --json-malo 0.05
+"""
+import argparse
+import asyncio
+import glob
+import itertools
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DIR_RESULTADOS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "resultados")
+UMBRAL_REGRESION = 0.2  # Aumento relativo de p95 que se informa como regresión
+
+# =============================
+# CLIENTE GEMINI FALSO
+# =============================
+class RespuestaFalsa:
+    def __init__(self, texto, tokens_entrada, tokens_salida):
+        self.text = texto
+        self.usage_metadata = type("Uso", (), {
+            "prompt_token_count": tokens_entrada,
+            "candidates_token_count": tokens_salida,
+            "total_token_count": tokens_entrada + tokens_salida,
+        })()
+
+class ModelosFalsos:
+    """
+    Imita client.aio.models: latencia configurable, errores, RESOURCE_EXHAUSTED y JSON malformado.
+    Las preguntas se arman con el generador local de main.py, en el formato JSON de Gemini.
+    """
+    def __init__(self, config, estadisticas):
+        self.config = config
+        self.estadisticas = estadisticas
+        self.rng = random.Random(config.get("semilla", 0))
+
+    def _pregunta_json(self):
+        import main
+        pregunta = main.generar_pregunta_local(self.rng)
+        # Las plantillas repiten código (algunas siempre el mismo) y el índice de duplicados
+        # las rechazaría: se antepone un bloque de constantes al azar que no cambia la salida,
+        # para que la tasa de fallos de cache refleje el cache y no la poca variedad del falso
+        constantes = "".join(
+            f"dato{self.rng.randrange(10 ** 6)} = {self.rng.randrange(10 ** 9)}\n" for _ in range(5)
+        )
+        return {
+            "Codigo": constantes + pregunta["codigo"],
+            "Pregunta": pregunta["pregunta"],
+            "Respuesta correcta": pregunta["respuesta_correcta"],
+            "Respuestas": pregunta["respuestas"],
+            "Explicacion": pregunta["explicacion"],
+            "tematicas_usadas": pregunta["tematicas_usadas"],
+        }
+
+    async def generate_content(self, model=None, contents=None, config=None):
+        self.estadisticas["llamadas"] += 1
+        latencia = self.rng.lognormvariate(0, 0.4) * self.config["latencia"]
+        await asyncio.sleep(latencia)
+        sorteo = self.rng.random()
+        if sorteo < self.config["cuota"]:
+            self.estadisticas["cuota"] += 1
+            raise RuntimeError("429 RESOURCE_EXHAUSTED. {'retryDelay': '2s'}")
+        if sorteo < self.config["cuota"] + self.config["error"]:
+            self.estadisticas["errores"] += 1
+            raise RuntimeError("503 UNAVAILABLE")
+        texto_prompt = contents if isinstance(contents, str) else json.dumps(contents, default=str, ensure_ascii=False)
+        coincidencia = re.search(r"Genera (\d+) ejercicios", texto_prompt)
+        cantidad = int(coincidencia.group(1)) if coincidencia else 1
+        texto = json.dumps([self._pregunta_json() for _ in range(cantidad)], ensure_ascii=False)
+        if self.rng.random() < self.config["json_malo"]:
+            self.estadisticas["json_malo"] += 1
+            texto = texto[: len(texto) // 2]
+        # La instrucción de sistema cuenta como entrada; Gemini puede servirla desde su cache implícito
+        sistema = len(str(getattr(config, "system_instruction", "") or "")) // 4
+        return RespuestaFalsa(texto, sistema + len(texto_prompt) // 4, len(texto) // 4)
+
+class ClienteGeminiFalso:
+    """
+    Sustituto de genai.Client con la misma forma: client.models y client.aio.models.
+    """
+    estadisticas = {"llamadas": 0, "cuota": 0, "errores": 0, "json_malo": 0}
+    config = {}
+
+    def __init__(self, *args, **kwargs):
+        modelos = ModelosFalsos(self.config, self.estadisticas)
+        self.aio = type("Aio", (), {"models": modelos})()
+        self.models = modelos
+
+# =============================
+# SIMULACIÓN DE ESTUDIANTES
+# =============================
+def percentil(valores, q):
+    if not valores:
+        return 0.0
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(q * len(ordenados)))]
+
+async def sesion_estudiante(transporte, latencias, errores, rng):
+    """
+    Una sesión completa: GET /quiz y luego 10 veces POST /quiz + GET /quiz.
+    """
+    import httpx
+    async with httpx.AsyncClient(transport=transporte, base_url="http://bench") as cliente:
+        async def pedir(metodo, ruta, **kwargs):
+            inicio = time.perf_counter()
+            respuesta = await cliente.request(metodo, ruta, **kwargs)
+            latencias.setdefault(f"{metodo} {ruta}", []).append(time.perf_counter() - inicio)
+            if respuesta.status_code >= 400 or "/error" in respuesta.headers.get("location", ""):
+                errores[0] += 1
+            return respuesta
+
+        respuesta = await pedir("GET", "/quiz")
+        for _ in range(10):
+            opciones = re.findall(r'name="respuesta" value="([^"]*)"', respuesta.text)
+            eleccion = rng.choice(opciones) if opciones else "?"
+            respuesta = await pedir("POST", "/quiz", data={"respuesta": eleccion})
+            destino = respuesta.headers.get("location", "")
+            if not destino.startswith("/quiz"):
+                break
+            respuesta = await pedir("GET", "/quiz")
+
+async def correr_escenario(escenario):
+    """
+    Ejecuta un escenario dentro de este proceso y devuelve sus resultados.
+    """
+    import httpx
+    from google import genai
+    ClienteGeminiFalso.config.update(escenario["gemini"])
+    genai.Client = ClienteGeminiFalso
+    sys.path.insert(0, RAIZ)
+    import main
+
+    transporte = httpx.ASGITransport(app=main.app)
+    latencias = {}
+    errores = [0]
+    rng = random.Random(escenario["gemini"].get("semilla", 0))
+    async with main.app.router.lifespan_context(main.app):
+        await asyncio.sleep(escenario["precalentamiento"])
+        inicio = time.perf_counter()
+        pendientes = escenario["sesiones"]
+        semaforo = asyncio.Semaphore(escenario["estudiantes"])
+
+        async def estudiante():
+            async with semaforo:
+                await sesion_estudiante(transporte, latencias, errores, rng)
+
+        await asyncio.gather(*(estudiante() for _ in range(pendientes)))
+        duracion = time.perf_counter() - inicio
+
+    aciertos = main.m_cache.valor("acierto")
+    fallos = main.m_cache.valor("fallo")
+    peticiones = sum(len(v) for v in latencias.values())
+    return {
+        "escenario": {k: v for k, v in escenario.items() if k != "gemini"},
+        "gemini": escenario["gemini"],
+        "duracion_segundos": round(duracion, 3),
+        "sesiones_por_segundo": round(escenario["sesiones"] / duracion, 3),
+        "peticiones_por_segundo": round(peticiones / duracion, 3),
+        "errores": errores[0],
+        "tasa_fallos_cache": round(fallos / (aciertos + fallos), 4) if aciertos + fallos else 0.0,
+        "dedup_evaluadas": main.indice_duplicados.evaluadas,
+        "dedup_rechazadas": main.indice_duplicados.duplicadas_exactas + main.indice_duplicados.casi_duplicadas,
+        "llamadas_gemini": dict(ClienteGeminiFalso.estadisticas),
+        "rutas": {
+            ruta: {
+                "cantidad": len(valores),
+                "p50_ms": round(percentil(valores, 0.50) * 1000, 2),
+                "p95_ms": round(percentil(valores, 0.95) * 1000, 2),
+                "p99_ms": round(percentil(valores, 0.99) * 1000, 2),
+            }
+            for ruta, valores in sorted(latencias.items())
+        },
+    }
+
+def ejecutar_en_subproceso(escenario):
+    """
+    Corre un escenario en un proceso nuevo con su propio entorno y banco temporal.
+    """
+    directorio = tempfile.mkdtemp(prefix="quiz-bench-")
+    entorno = dict(os.environ)
+    entorno.update({
+        "SESSION_SECRET_KEY": "benchmark",
+        "GENAI_API_KEY": "falsa",
+        "QUIZ_DB_PATH": os.path.join(directorio, "preguntas.db"),
+        "CACHE_LOCAL": str(escenario["cache_local"]),
+        "GEN_CONCURRENCIA": str(escenario["gen_concurrencia"]),
+        "GEN_RPM": str(escenario["gen_rpm"]),
+        "GEN_RPM_MAX": str(escenario["gen_rpm"] * 4),
+    })
+    proceso = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--escenario", json.dumps(escenario)],
+        env=entorno, capture_output=True, text=True, cwd=RAIZ
+    )
+    if proceso.returncode != 0:
+        raise RuntimeError(f"El escenario falló:\n{proceso.stderr}")
+    return json.loads(proceso.stdout.strip().splitlines()[-1])
+
+def comparar_con_anterior(resultados):
+    """
+    Compara los p95 por ruta con la corrida anterior equivalente y devuelve las regresiones.
+    """
+    anteriores = sorted(glob.glob(os.path.join(DIR_RESULTADOS, "*.json")))
+    if not anteriores:
+        return []
+    with open(anteriores[-1], encoding="utf-8") as archivo:
+        previos = {json.dumps(r["escenario"], sort_keys=True): r for r in json.load(archivo)["escenarios"]}
+    regresiones = []
+    for resultado in resultados:
+        previo = previos.get(json.dumps(resultado["escenario"], sort_keys=True))
+        if previo is None:
+            continue
+        for ruta, datos in resultado["rutas"].items():
+            antes = previo["rutas"].get(ruta, {}).get("p95_ms")
+            if antes and datos["p95_ms"] > antes * (1 + UMBRAL_REGRESION):
+                regresiones.append(
+                    f"{ruta} {resultado['escenario']}: p95 {antes} ms -> {datos['p95_ms']} ms"
+                )
+    return regresiones
+
+def imprimir(resultado):
+    escenario = resultado["escenario"]
+    print(f"\nEstudiantes={escenario['estudiantes']} cache_local={escenario['cache_local']} "
+          f"sesiones={escenario['sesiones']} -> {resultado['sesiones_por_segundo']} sesiones/s, "
+          f"{resultado['peticiones_por_segundo']} req/s, fallos de cache {resultado['tasa_fallos_cache']:.1%} "
+          f"(duplicadas rechazadas {resultado.get('dedup_rechazadas', 0)}/{resultado.get('dedup_evaluadas', 0)}), "
+          f"errores {resultado['errores']}")
+    for ruta, datos in resultado["rutas"].items():
+        print(f"  {ruta:<10} n={datos['cantidad']:<6} p50={datos['p50_ms']:>8} ms "
+              f"p95={datos['p95_ms']:>8} ms p99={datos['p99_ms']:>8} ms")
+
+def lista_enteros(texto):
+    return [int(valor) for valor in texto.split(",") if valor]
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de carga del quiz con Gemini simulado")
+    parser.add_argument("--estudiantes", type=lista_enteros, default=[10, 50], help="Estudiantes concurrentes")
+    parser.add_argument("--cache-local", type=lista_enteros, default=[20], help="Valores de CACHE_LOCAL")
+    parser.add_argument("--sesiones", type=int, default=0, help="Sesiones totales por escenario (por defecto 2 por estudiante)")
+    parser.add_argument("--gen-concurrencia", type=int, default=2)
+    parser.add_argument("--gen-rpm", type=float, default=60)
+    parser.add_argument("--latencia", type=float, default=1.0, help="Latencia media de Gemini en segundos")
+    parser.add_argument("--error", type=float, default=0.02, help="Proporción de errores genéricos")
+    parser.add_argument("--cuota", type=float, default=0.02, help="Proporción de RESOURCE_EXHAUSTED")
+    parser.add_argument("--json-malo", type=float, default=0.05, help="Proporción de respuestas con JSON malformado")
+    parser.add_argument("--precalentamiento", type=float, default=3.0, help="Segundos de precarga antes de medir")
+    parser.add_argument("--semilla", type=int, default=0)
+    parser.add_argument("--no-guardar", action="store_true", help="No guardar los resultados en bench/resultados")
+    parser.add_argument("--escenario", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.escenario:
+        # Modo hijo: un solo escenario, resultado en JSON por stdout
+        print(json.dumps(asyncio.run(correr_escenario(json.loads(args.escenario)))))
+        return
+
+    gemini = {"latencia": args.latencia, "error": args.error, "cuota": args.cuota,
+              "json_malo": args.json_malo, "semilla": args.semilla}
+    resultados = []
+    for estudiantes, cache_local in itertools.product(args.estudiantes, args.cache_local):
+        escenario = {
+            "estudiantes": estudiantes,
+            "cache_local": cache_local,
+            "sesiones": args.sesiones or estudiantes * 2,
+            "gen_concurrencia": args.gen_concurrencia,
+            "gen_rpm": args.gen_rpm,
+            "precalentamiento": args.precalentamiento,
+            "gemini": gemini,
+        }
+        resultado = ejecutar_en_subproceso(escenario)
+        imprimir(resultado)
+        resultados.append(resultado)
+
+    regresiones = comparar_con_anterior(resultados)
+    for regresion in regresiones:
+        print(f"REGRESIÓN: {regresion}")
+    if not args.no_guardar:
+        os.makedirs(DIR_RESULTADOS, exist_ok=True)
+        ruta = os.path.join(DIR_RESULTADOS, time.strftime("%Y%m%d-%H%M%S") + ".json")
+        with open(ruta, "w", encoding="utf-8") as archivo:
+            json.dump({"fecha": time.strftime("%Y-%m-%dT%H:%M:%S"), "escenarios": resultados,
+                       "regresiones": regresiones}, archivo, ensure_ascii=False, indent=2)
+        print(f"\nResultados guardados en {ruta}")
+
+if __name__ == "__main__":
+    main()
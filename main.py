@@ -2,17 +2,42 @@
 # CONFIGURACIÓN Y DEPENDENCIAS
 # =============================
 from fastapi import FastAPI, Request, Form, Response
-from fastapi.responses import RedirectResponse
+from fastapi.responses import RedirectResponse, PlainTextResponse, JSONResponse, HTMLResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
+from markupsafe import escape
 from itsdangerous import URLSafeSerializer, BadSignature
+from cachetools import LRUCache, TTLCache
 import os
 from dotenv import load_dotenv
 import json
+import csv
+import gzip
+import hashlib
+import bisect
+import io
+import keyword
+import tokenize
+import builtins
+import ast
+import sys
+import tempfile
+from array import array
+import secrets
+import math
 import time
 import threading
-import queue
+import sqlite3
+try:
+    import fcntl
+except ImportError:  # Windows: no hay flock, cada proceso actúa como productor
+    fcntl = None
 from google import genai
+from google.genai import types
 import asyncio
+import random
+import re
+from collections import deque
+from contextlib import asynccontextmanager
 
 # Carga variables de entorno desde .env
 load_dotenv()
@@ -131,14 +156,695 @@ Devuelve únicamente un objeto JSON con esta estructura exacta:
 # =============================
 # CLIENTE GENAI
 # =============================
-client = genai.Client(api_key=GENAI_API_KEY)
+# Se crea en la primera llamada: importar el módulo (tests, fork de workers) no abre conexiones
+_cliente = None
+
+def obtener_cliente():
+    global _cliente
+    if _cliente is None:
+        _cliente = genai.Client(api_key=GENAI_API_KEY)
+    return _cliente
+
+# =============================
+# MÉTRICAS E INSTRUMENTACIÓN
+# =============================
+# Contadores, indicadores e histogramas en memoria del worker, con etiquetas
+# opcionales. Registrar una observación es una suma y una búsqueda binaria.
+BUCKETS_LATENCIA = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class Metrica:
+    """
+    Base de las métricas: nombre, ayuda y una serie por combinación de etiquetas.
+    """
+    tipo = "untyped"
+
+    def __init__(self, nombre, ayuda, etiquetas=()):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = tuple(etiquetas)
+        self._series = {}
+
+    def labels(self, *valores):
+        serie = self._series.get(valores)
+        if serie is None:
+            serie = self._series[valores] = self._nueva_serie()
+        return serie
+
+    def _sin_etiquetas(self):
+        return self.labels()
+
+    def _formato_etiquetas(self, valores, extra=()):
+        pares = list(zip(self.etiquetas, valores)) + list(extra)
+        if not pares:
+            return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in pares) + "}"
+
+class _SerieContador:
+    __slots__ = ("valor",)
+
+    def __init__(self):
+        self.valor = 0.0
+
+    def inc(self, cantidad=1):
+        self.valor += cantidad
+
+    def set(self, valor):
+        self.valor = valor
+
+class Contador(Metrica):
+    tipo = "counter"
+    _nueva_serie = _SerieContador
+
+    def inc(self, cantidad=1):
+        self._sin_etiquetas().inc(cantidad)
+
+    def valor(self, *valores):
+        serie = self._series.get(valores)
+        return serie.valor if serie else 0.0
+
+    def exponer(self):
+        for valores, serie in self._series.items():
+            yield f"{self.nombre}{self._formato_etiquetas(valores)} {serie.valor}"
+
+    def resumen(self):
+        return {",".join(map(str, v)) or "total": s.valor for v, s in self._series.items()}
+
+class Indicador(Contador):
+    """
+    Valor que sube y baja (gauge). Puede calcularse al exponer con una función.
+    """
+    tipo = "gauge"
+
+    def __init__(self, nombre, ayuda, etiquetas=(), funcion=None):
+        super().__init__(nombre, ayuda, etiquetas)
+        self.funcion = funcion
+
+    def set(self, valor):
+        self._sin_etiquetas().set(valor)
+
+    def exponer(self):
+        if self.funcion is not None:
+            self.set(self.funcion())
+        return super().exponer()
+
+    def resumen(self):
+        if self.funcion is not None:
+            self.set(self.funcion())
+        return super().resumen()
+
+class _SerieHistograma:
+    __slots__ = ("limites", "cuentas", "suma", "total")
+
+    def __init__(self, limites):
+        self.limites = limites
+        self.cuentas = [0] * (len(limites) + 1)
+        self.suma = 0.0
+        self.total = 0
+
+    def observe(self, valor):
+        self.cuentas[bisect.bisect_left(self.limites, valor)] += 1
+        self.suma += valor
+        self.total += 1
+
+    def cuantil(self, q):
+        """
+        Estimación del cuantil por el límite superior del bucket que lo contiene.
+        """
+        if not self.total:
+            return 0.0
+        objetivo = q * self.total
+        acumulado = 0
+        for limite, cuenta in zip(self.limites, self.cuentas):
+            acumulado += cuenta
+            if acumulado >= objetivo:
+                return limite
+        return float("inf")
+
+class Histograma(Metrica):
+    tipo = "histogram"
+
+    def __init__(self, nombre, ayuda, etiquetas=(), limites=BUCKETS_LATENCIA):
+        super().__init__(nombre, ayuda, etiquetas)
+        self.limites = tuple(limites)
+
+    def _nueva_serie(self):
+        return _SerieHistograma(self.limites)
+
+    def observe(self, valor):
+        self._sin_etiquetas().observe(valor)
+
+    def exponer(self):
+        for valores, serie in self._series.items():
+            acumulado = 0
+            for limite, cuenta in zip(serie.limites, serie.cuentas):
+                acumulado += cuenta
+                yield f"{self.nombre}_bucket{self._formato_etiquetas(valores, [('le', limite)])} {acumulado}"
+            yield f"{self.nombre}_bucket{self._formato_etiquetas(valores, [('le', '+Inf')])} {serie.total}"
+            yield f"{self.nombre}_sum{self._formato_etiquetas(valores)} {serie.suma}"
+            yield f"{self.nombre}_count{self._formato_etiquetas(valores)} {serie.total}"
+
+    def resumen(self):
+        return {
+            ",".join(map(str, v)) or "total": {
+                "cantidad": s.total,
+                "promedio": s.suma / s.total if s.total else 0.0,
+                "p50": s.cuantil(0.5), "p95": s.cuantil(0.95), "p99": s.cuantil(0.99),
+            }
+            for v, s in self._series.items()
+        }
+
+class RegistroMetricas:
+    def __init__(self):
+        self.metricas = []
+
+    def registrar(self, metrica):
+        self.metricas.append(metrica)
+        return metrica
+
+    def texto_prometheus(self):
+        lineas = []
+        for metrica in self.metricas:
+            lineas.append(f"# HELP {metrica.nombre} {metrica.ayuda}")
+            lineas.append(f"# TYPE {metrica.nombre} {metrica.tipo}")
+            lineas.extend(metrica.exponer())
+        return "\n".join(lineas) + "\n"
+
+    def resumen(self):
+        return {metrica.nombre: metrica.resumen() for metrica in self.metricas}
+
+class cronometro:
+    """
+    Context manager que registra en un histograma la duración del bloque.
+    """
+    __slots__ = ("serie", "inicio")
+
+    def __init__(self, serie):
+        self.serie = serie
+
+    def __enter__(self):
+        self.inicio = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.serie.observe(time.perf_counter() - self.inicio)
+        return False
+
+metricas = RegistroMetricas()
+m_peticiones = metricas.registrar(Histograma(
+    "quiz_peticion_segundos", "Duración de las peticiones HTTP por ruta", ("ruta", "metodo")))
+m_gemini_latencia = metricas.registrar(Histograma(
+    "quiz_gemini_latencia_segundos", "Latencia de las llamadas a Gemini"))
+m_gemini_errores = metricas.registrar(Contador(
+    "quiz_gemini_errores_total", "Llamadas a Gemini fallidas por tipo", ("tipo",)))
+m_json_invalido = metricas.registrar(Contador(
+    "quiz_json_invalido_total", "Respuestas de Gemini que no se pudieron interpretar como JSON"))
+m_preguntas_generadas = metricas.registrar(Contador(
+    "quiz_preguntas_generadas_total", "Preguntas válidas recibidas de Gemini"))
+m_cache = metricas.registrar(Contador(
+    "quiz_cache_total", "Resultados de obtener una pregunta del cache", ("resultado",)))
+m_cache_espera = metricas.registrar(Histograma(
+    "quiz_cache_espera_segundos", "Tiempo para obtener una pregunta (cache o respaldo local)"))
+m_reintentos = metricas.registrar(Contador(
+    "quiz_reintentos_total", "Iteraciones de los bucles de reintento de las rutas", ("ruta",)))
+m_gemini_tokens = metricas.registrar(Histograma(
+    "quiz_gemini_tokens", "Tokens por llamada a Gemini (entrada, de cache, salida y total)", ("tipo",),
+    limites=(50, 100, 250, 500, 1000, 2000, 4000, 8000, 16000)))
+m_sesion = metricas.registrar(Histograma(
+    "quiz_sesion_segundos", "Costo de leer y guardar la sesión (firma de cookie y almacén)", ("operacion",)))
+m_respaldo = metricas.registrar(Contador(
+    "quiz_respaldo_total", "Preguntas servidas sin cache: recicladas del banco o del generador local", ("origen",)))
+m_intentos = metricas.registrar(Contador(
+    "quiz_intentos_total", "Respuestas registradas en el historial o descartadas (cola llena o error de escritura)", ("resultado",)))
 
 # =============================
 # CACHE DE PREGUNTAS (COLA)
 # =============================
-CACHE_SIZE = 200  # Máximo de preguntas en cache
-CACHE_MIN = 100   # Umbral mínimo para reponer el cache
-pregunta_cache = queue.Queue(maxsize=CACHE_SIZE)
+# El banco persistente es el pool compartido por todos los workers; cada worker
+# guarda en memoria solo una pequeña porción reservada para él.
+# El objetivo de reposición se calcula según la demanda observada, entre estos dos límites
+CACHE_SIZE = int(os.getenv("CACHE_SIZE", "1000"))  # Máximo de preguntas pendientes en el banco compartido
+CACHE_MIN = int(os.getenv("CACHE_MIN", "100"))     # Objetivo mínimo del banco, aun sin demanda
+HORIZONTE_DEMANDA = int(os.getenv("HORIZONTE_DEMANDA", "300"))  # Segundos de consumo que el banco debe cubrir
+CACHE_LOCAL = int(os.getenv("CACHE_LOCAL", "20"))  # Preguntas reservadas en memoria por worker
+PREGUNTAS_POR_LLAMADA = int(os.getenv("PREGUNTAS_POR_LLAMADA", "5"))  # Preguntas pedidas en cada llamada a Gemini
+RESERVA_TTL = 15 * 60  # Segundos tras los que una reserva no servida vuelve al pool
+GEN_CONCURRENCIA = int(os.getenv("GEN_CONCURRENCIA", "2"))  # Llamadas simultáneas a Gemini por worker
+GEN_RPM = float(os.getenv("GEN_RPM", "12"))  # Llamadas por minuto iniciales a Gemini
+GEN_RPM_MAX = float(os.getenv("GEN_RPM_MAX", "30"))  # Techo al que puede crecer el ritmo adaptativo
+# Se activa cuando el cache local baja de la mitad, para despertar la reposición
+evento_reponer = asyncio.Event()
+
+# =============================
+# TEMÁTICAS E INVENTARIO POR TEMÁTICA
+# =============================
+# Temáticas principales del PROMPT. Cada pregunta se clasifica por su temática
+# principal, y tanto el banco como el cache local se organizan por temática.
+TEMATICAS = [
+    "concatenación de cadenas",
+    "manipulación de strings",
+    "operaciones entre tipos distintos (int, float, str)",
+    "intercambio de valores entre variables",
+    "cálculos matemáticos simples",
+    "nombre",
+    "altura",
+    "precio de producto",
+    "peso",
+    "edad",
+]
+TEMA_OTRAS = "otras"
+# Regla 2 del PROMPT: edad, precio, altura y peso solo después de al menos 3 ejercicios de otras
+# temáticas. Al balancear el stock pesan una cuarta parte, así que entre las cuatro suman lo mismo
+# que una temática común y el banco no las pide como principales más seguido de lo que la regla admite.
+TEMATICAS_RESTRINGIDAS = {"edad", "precio de producto", "altura", "peso"}
+PESO_TEMATICA = {tema: 0.25 if tema in TEMATICAS_RESTRINGIDAS else 1.0 for tema in TEMATICAS}
+# Palabras clave para reconocer la temática en el texto libre de 'tematicas_usadas' (en orden de prioridad)
+_CLAVES_TEMATICAS = [
+    ("concaten", "concatenación de cadenas"),
+    ("intercambi", "intercambio de valores entre variables"),
+    ("tipo", "operaciones entre tipos distintos (int, float, str)"),
+    ("string", "manipulación de strings"),
+    ("cadena", "manipulación de strings"),
+    ("precio", "precio de producto"),
+    ("producto", "precio de producto"),
+    ("altura", "altura"),
+    ("peso", "peso"),
+    ("edad", "edad"),
+    ("nombre", "nombre"),
+    ("cálculo", "cálculos matemáticos simples"),
+    ("calculo", "cálculos matemáticos simples"),
+    ("matemát", "cálculos matemáticos simples"),
+    ("aritmét", "cálculos matemáticos simples"),
+]
+
+def clasificar_tematica(pregunta):
+    """
+    Devuelve la temática canónica de la pregunta, según la primera de 'tematicas_usadas' que se reconozca.
+    """
+    for tematica in pregunta.get("tematicas_usadas") or []:
+        texto = str(tematica).lower()
+        for clave, tema in _CLAVES_TEMATICAS:
+            if clave in texto:
+                return tema
+    return TEMA_OTRAS
+
+class InventarioTematico:
+    """
+    Cache en memoria del worker con una sub-cola por temática.
+    Al sacar una pregunta elige, entre las temáticas que la sesión todavía no vio,
+    la que tiene más stock; el costo es constante (hay un número fijo de temáticas).
+    """
+    def __init__(self, capacidad):
+        self.capacidad = capacidad
+        self.colas = {tema: deque() for tema in TEMATICAS + [TEMA_OTRAS]}
+        self.total = 0
+
+    def qsize(self):
+        return self.total
+
+    def stock(self, tema):
+        return len(self.colas.get(tema, ()))
+
+    def put_nowait(self, pregunta):
+        tema = pregunta.get("tema") or clasificar_tematica(pregunta)
+        self.colas.setdefault(tema, deque()).append(pregunta)
+        self.total += 1
+
+    def tomar(self, excluir=()):
+        """
+        Saca una pregunta de una temática no incluida en 'excluir' (si no hay, de cualquiera).
+        Devuelve None si el inventario está vacío.
+        """
+        if not self.total:
+            return None
+        mejor = None
+        for tema, cola in self.colas.items():
+            if cola and tema not in excluir and (mejor is None or len(cola) > len(self.colas[mejor])):
+                mejor = tema
+        if mejor is None:
+            mejor = max(self.colas, key=lambda tema: len(self.colas[tema]))
+        self.total -= 1
+        return self.colas[mejor].popleft()
+
+    def resumen(self):
+        return {tema: len(cola) for tema, cola in self.colas.items() if cola}
+
+pregunta_cache = InventarioTematico(CACHE_LOCAL)
+
+# =============================
+# BANCO PERSISTENTE DE PREGUNTAS (SQLITE)
+# =============================
+DB_PATH = os.getenv("QUIZ_DB_PATH", os.path.join(os.path.dirname(__file__), "preguntas.db"))
+
+class ConexionesSQLite:
+    """
+    Base para los almacenes sobre SQLite: una conexión por hilo, en modo WAL.
+    """
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self._local = threading.local()
+        self._conexion().execute("PRAGMA journal_mode=WAL")
+
+    def _conexion(self):
+        con = getattr(self._local, "con", None)
+        if con is None:
+            con = sqlite3.connect(self.ruta, timeout=30, isolation_level=None)
+            con.execute("PRAGMA synchronous=NORMAL")
+            self._local.con = con
+        return con
+
+    def _asegurar_columna(self, tabla, columna, tipo):
+        con = self._conexion()
+        columnas = [fila[1] for fila in con.execute(f"PRAGMA table_info({tabla})")]
+        if columna not in columnas:
+            con.execute(f"ALTER TABLE {tabla} ADD COLUMN {columna} {tipo}")
+
+class BancoPreguntas(ConexionesSQLite):
+    """
+    Almacén durable de preguntas sobre SQLite en modo WAL.
+    Sobrevive a reinicios y despliegues, registra qué preguntas ya fueron
+    servidas y permite volcar en el cache las pendientes al arrancar.
+    Es compartido por todos los workers: las reservas y la marca de servida
+    son atómicas, por lo que cada pregunta se entrega una sola vez.
+    """
+    def __init__(self, ruta):
+        super().__init__(ruta)
+        self._conexion().executescript(
+            """
+            CREATE TABLE IF NOT EXISTS preguntas (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                datos TEXT NOT NULL,
+                creada REAL NOT NULL,
+                reservada REAL,
+                reservada_por INTEGER,
+                servida REAL,
+                tema TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_preguntas_pendientes
+                ON preguntas(servida, reservada, id);
+            CREATE TABLE IF NOT EXISTS circuito_gemini (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                estado TEXT NOT NULL,
+                fallos_seguidos INTEGER NOT NULL,
+                abierto_hasta REAL NOT NULL,
+                aperturas INTEGER NOT NULL,
+                rechazadas INTEGER NOT NULL,
+                actualizado REAL NOT NULL
+            );
+            """
+        )
+        # Bancos creados por versiones anteriores
+        self._asegurar_columna("preguntas", "reservada_por", "INTEGER")
+        self._asegurar_columna("preguntas", "tema", "TEXT")
+        self._clasificar_pendientes()
+        self._conexion().execute(
+            "CREATE INDEX IF NOT EXISTS idx_preguntas_tema ON preguntas(tema, servida, reservada, id)"
+        )
+
+    def _clasificar_pendientes(self):
+        """
+        Asigna la temática a las preguntas pendientes guardadas antes de existir la columna.
+        """
+        con = self._conexion()
+        filas = con.execute("SELECT id, datos FROM preguntas WHERE tema IS NULL AND servida IS NULL").fetchall()
+        for id_pregunta, datos in filas:
+            con.execute("UPDATE preguntas SET tema = ? WHERE id = ?",
+                        (clasificar_tematica(json.loads(datos)), id_pregunta))
+
+    def agregar_lote(self, preguntas, servida=False):
+        """
+        Inserta varias preguntas en una sola transacción y les asigna su 'id'.
+        Si servida=True se registran como ya entregadas (generación en caliente).
+        """
+        ahora = time.time()
+        con = self._conexion()
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            for pregunta in preguntas:
+                pregunta["tema"] = pregunta.get("tema") or clasificar_tematica(pregunta)
+                datos = {k: v for k, v in pregunta.items() if k != "id"}
+                cur = con.execute(
+                    "INSERT INTO preguntas (datos, creada, reservada, servida, tema) VALUES (?, ?, ?, ?, ?)",
+                    (json.dumps(datos, ensure_ascii=False), ahora,
+                     ahora if servida else None, ahora if servida else None, pregunta["tema"])
+                )
+                pregunta["id"] = cur.lastrowid
+            con.execute("COMMIT")
+        except Exception:
+            con.execute("ROLLBACK")
+            raise
+        return preguntas
+
+    def reservar(self, limite, tema=None):
+        """
+        Marca como reservadas por este proceso hasta 'limite' preguntas pendientes
+        (las más antiguas primero, opcionalmente de una temática) y las devuelve
+        para cargarlas en el cache en memoria.
+        """
+        filtro_tema = "AND tema = ?" if tema is not None else ""
+        parametros = (time.time(), os.getpid()) + ((tema,) if tema is not None else ()) + (limite,)
+        cur = self._conexion().execute(
+            f"""
+            UPDATE preguntas SET reservada = ?, reservada_por = ?
+            WHERE id IN (
+                SELECT id FROM preguntas
+                WHERE servida IS NULL AND reservada IS NULL {filtro_tema}
+                ORDER BY id LIMIT ?
+            )
+            RETURNING id, datos
+            """,
+            parametros
+        )
+        preguntas = []
+        for id_pregunta, datos in sorted(cur.fetchall()):
+            pregunta = json.loads(datos)
+            pregunta["id"] = id_pregunta
+            preguntas.append(pregunta)
+        return preguntas
+
+    def reservar_por_tema(self, cupos, extra=0):
+        """
+        Reserva hasta cupos[tema] preguntas de cada temática y luego hasta 'extra'
+        de cualquiera, para que el cache local quede balanceado.
+        """
+        preguntas = []
+        for tema, cupo in cupos.items():
+            if cupo > 0:
+                preguntas.extend(self.reservar(cupo, tema))
+        faltan = extra - len(preguntas)
+        if faltan > 0:
+            preguntas.extend(self.reservar(faltan))
+        return preguntas
+
+    def tomar_juego(self, cantidad):
+        """
+        Toma en bloque hasta 'cantidad' preguntas pendientes alternando temáticas
+        (la más antigua de cada una primero) y las marca como servidas.
+        """
+        ahora = time.time()
+        cur = self._conexion().execute(
+            """
+            UPDATE preguntas SET reservada = ?, reservada_por = ?, servida = ?
+            WHERE id IN (
+                SELECT id FROM (
+                    SELECT id, ROW_NUMBER() OVER (PARTITION BY tema ORDER BY id) AS orden
+                    FROM preguntas
+                    WHERE servida IS NULL AND reservada IS NULL
+                )
+                ORDER BY orden, id LIMIT ?
+            )
+            RETURNING id, datos
+            """,
+            (ahora, os.getpid(), ahora, cantidad)
+        )
+        preguntas = []
+        for id_pregunta, datos in cur.fetchall():
+            pregunta = json.loads(datos)
+            pregunta["id"] = id_pregunta
+            preguntas.append(pregunta)
+        return preguntas
+
+    def obtener(self, id_pregunta):
+        """
+        Devuelve la pregunta con ese id, o None si no existe.
+        """
+        fila = self._conexion().execute(
+            "SELECT datos FROM preguntas WHERE id = ?", (id_pregunta,)
+        ).fetchone()
+        if fila is None:
+            return None
+        pregunta = json.loads(fila[0])
+        pregunta["id"] = id_pregunta
+        return pregunta
+
+    def iterar_recientes_gemini(self, limite):
+        """
+        Recorre el código y las respuestas de las 'limite' preguntas de Gemini más recientes
+        (servidas o no), sin las del generador local ni el resto de los datos.
+        """
+        cur = self._conexion().execute(
+            """
+            SELECT id, json_extract(datos, '$.codigo'), json_extract(datos, '$.respuestas') FROM preguntas
+            WHERE json_extract(datos, '$.origen') IS NULL
+            ORDER BY id DESC LIMIT ?
+            """,
+            (limite,)
+        )
+        for id_pregunta, codigo, respuestas in cur:
+            yield {"id": id_pregunta, "codigo": codigo, "respuestas": json.loads(respuestas or "[]")}
+
+    def obtener_reciclada(self, excluir_temas=()):
+        """
+        Devuelve una pregunta de Gemini ya servida, elegida al azar y de una temática no
+        excluida, o None si no hay. Se usa mientras Gemini no está disponible.
+        """
+        con = self._conexion()
+        minimo, maximo = con.execute("SELECT MIN(id), MAX(id) FROM preguntas").fetchone()
+        if minimo is None:
+            return None
+        excluir_temas = list(excluir_temas)
+        filtro_tema = f"AND tema NOT IN ({', '.join('?' * len(excluir_temas))})" if excluir_temas else ""
+        consulta = f"""
+            SELECT id, datos FROM preguntas
+            WHERE id >= ? AND servida IS NOT NULL AND json_extract(datos, '$.origen') IS NULL {filtro_tema}
+            ORDER BY id LIMIT 1
+        """
+        # Desde un id al azar; si no hay ninguna después, desde el principio
+        for desde in (random.randint(minimo, maximo), minimo):
+            fila = con.execute(consulta, [desde] + excluir_temas).fetchone()
+            if fila:
+                pregunta = json.loads(fila[1])
+                pregunta["id"] = fila[0]
+                return pregunta
+        return None
+
+    def liberar_reservas(self, antiguedad=RESERVA_TTL):
+        """
+        Devuelve al pool las preguntas reservadas hace más de 'antiguedad' segundos
+        y no servidas (por ejemplo, las que quedaron en memoria de un worker caído).
+        """
+        self._conexion().execute(
+            "UPDATE preguntas SET reservada = NULL, reservada_por = NULL "
+            "WHERE servida IS NULL AND reservada < ?",
+            (time.time() - antiguedad,)
+        )
+
+    def liberar_reservas_huerfanas(self):
+        """
+        Devuelve al pool las reservas de procesos que ya no existen.
+        """
+        con = self._conexion()
+        pids = [fila[0] for fila in con.execute(
+            "SELECT DISTINCT reservada_por FROM preguntas "
+            "WHERE servida IS NULL AND reservada_por IS NOT NULL"
+        )]
+        for pid in pids:
+            if pid != os.getpid() and not proceso_vivo(pid):
+                con.execute(
+                    "UPDATE preguntas SET reservada = NULL, reservada_por = NULL "
+                    "WHERE servida IS NULL AND reservada_por = ?",
+                    (pid,)
+                )
+
+    def marcar_servida(self, id_pregunta):
+        """
+        Registra que la pregunta fue entregada a un usuario.
+        Devuelve False si otro worker ya la había servido.
+        """
+        cur = self._conexion().execute(
+            "UPDATE preguntas SET servida = ? WHERE id = ? AND servida IS NULL",
+            (time.time(), id_pregunta)
+        )
+        return cur.rowcount == 1
+
+    def contar_pendientes(self):
+        """
+        Cantidad de preguntas que aún no fueron servidas.
+        """
+        return self._conexion().execute(
+            "SELECT COUNT(*) FROM preguntas WHERE servida IS NULL"
+        ).fetchone()[0]
+
+    def contar_servidas(self, desde):
+        """
+        Cantidad de preguntas servidas (por cualquier worker) desde el instante 'desde'.
+        """
+        return self._conexion().execute(
+            "SELECT COUNT(*) FROM preguntas WHERE servida >= ?", (desde,)
+        ).fetchone()[0]
+
+    def contar_disponibles_por_tema(self):
+        """
+        Preguntas disponibles (pendientes y sin reservar) de cada temática.
+        """
+        return dict(self._conexion().execute(
+            "SELECT tema, COUNT(*) FROM preguntas WHERE servida IS NULL AND reservada IS NULL GROUP BY tema"
+        ).fetchall())
+
+    def contar_disponibles(self):
+        """
+        Cantidad de preguntas pendientes que ningún worker tiene reservadas.
+        """
+        return self._conexion().execute(
+            "SELECT COUNT(*) FROM preguntas WHERE servida IS NULL AND reservada IS NULL"
+        ).fetchone()[0]
+
+    def guardar_circuito(self, estado):
+        """
+        Publica el estado del circuito de Gemini del productor para el resto de los workers.
+        """
+        self._conexion().execute(
+            "INSERT OR REPLACE INTO circuito_gemini "
+            "(id, estado, fallos_seguidos, abierto_hasta, aperturas, rechazadas, actualizado) "
+            "VALUES (1, ?, ?, ?, ?, ?, ?)",
+            (estado["estado"], estado["fallos_seguidos"], estado["abierto_hasta"],
+             estado["aperturas"], estado["rechazadas"], time.time())
+        )
+
+    def leer_circuito(self):
+        """
+        Último estado publicado del circuito de Gemini, o None si ningún productor lo publicó.
+        """
+        fila = self._conexion().execute(
+            "SELECT estado, fallos_seguidos, abierto_hasta, aperturas, rechazadas FROM circuito_gemini WHERE id = 1"
+        ).fetchone()
+        if fila is None:
+            return None
+        return dict(zip(("estado", "fallos_seguidos", "abierto_hasta", "aperturas", "rechazadas"), fila))
+
+def proceso_vivo(pid):
+    """
+    Indica si existe un proceso con ese pid en la máquina local.
+    """
+    if os.name == "nt":  # En Windows os.kill(pid, 0) terminaría el proceso
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True
+    return True
+
+banco = BancoPreguntas(DB_PATH)
+
+async def cargar_cache_desde_banco():
+    """
+    Completa el cache en memoria del worker con preguntas pendientes del banco compartido,
+    repartiendo el espacio libre entre las temáticas con menos stock.
+    Devuelve la cantidad de preguntas cargadas.
+    """
+    libres = CACHE_LOCAL - pregunta_cache.qsize()
+    if libres <= 0:
+        return 0
+    peso_total = sum(PESO_TEMATICA.values())
+    cupos = {
+        tema: max(0, max(1, int(CACHE_LOCAL * PESO_TEMATICA[tema] / peso_total)) - pregunta_cache.stock(tema))
+        for tema in TEMATICAS
+    }
+    preguntas = await asyncio.to_thread(banco.reservar_por_tema, cupos, libres)
+    for pregunta in preguntas:
+        pregunta_cache.put_nowait(pregunta)
+    return len(preguntas)
 
 # =============================
 # VALIDACIÓN DE PREGUNTAS
@@ -159,118 +865,1716 @@ def es_pregunta_valida(pregunta):
         return False
     return True
 
+# =============================
+# GENERADOR LOCAL DE RESPALDO
+# =============================
+# Ejercicios secuenciales armados a partir de plantillas, sin red. Se usan
+# cuando el cache está vacío (Gemini limitado o caído) para no hacer esperar
+# al usuario. La salida se obtiene ejecutando el propio código generado, así
+# que la respuesta correcta siempre es exacta.
+_NOMBRES_LOCAL = ["Ulises", "Brisa", "Tadeo", "Milena", "Olmo", "Yara", "Caetano", "Ámbar", "Fermín",
+                  "Iara", "Quirino", "Selva", "Bautista", "Noa", "Lisandro", "Rocío", "Eluney", "Dalmiro"]
+_PALABRAS_LOCAL = ["cometa", "brújula", "farol", "lazo", "tinta", "nube", "grillo", "muelle", "arce",
+                   "sol", "eco", "pixel", "nodo", "clave", "ruta", "ancla", "faro", "mapa"]
+_PRODUCTOS_LOCAL = ["cuaderno", "linterna", "taza", "mochila", "regla", "auricular", "maceta", "lámpara"]
+
+def _valor(rng, minimo=2, maximo=40, evitar=(1, 2, 3, 5, 6, 7, 12, 15)):
+    """
+    Entero al azar que evita los valores más repetidos por el generador de IA.
+    """
+    while True:
+        valor = rng.randint(minimo, maximo)
+        if valor not in evitar:
+            return valor
+
+def _plantilla_concatenacion(rng):
+    saludo = rng.choice(["Hola", "Buen día", "Bienvenido", "Saludos"])
+    nombre = rng.choice(_NOMBRES_LOCAL)
+    signo = rng.choice(["!", ".", "?"])
+    codigo = (
+        f'saludo = "{saludo}"\n'
+        f'nombreUsuario = "{nombre}"\n'
+        f'mensaje = saludo + ", " + nombreUsuario + "{signo}"\n'
+        f'print(mensaje)'
+    )
+    distractores = [f"{saludo} {nombre}{signo}", f"{saludo},{nombre}{signo}", f"{nombre}, {saludo}{signo}",
+                    f"saludo, nombreUsuario{signo}"]
+    explicacion = "La concatenación con + une las cadenas en el orden escrito, incluyendo la coma y el espacio literales."
+    return codigo, "", "¿Qué imprime el siguiente código?", distractores, explicacion, \
+        ["concatenación de cadenas", "nombre"]
+
+def _plantilla_strings(rng):
+    palabra = rng.choice(_PALABRAS_LOCAL)
+    veces = rng.randint(2, 4)
+    sufijo = rng.choice(["-", "*", "!", "#"])
+    codigo = (
+        f'palabraBase = "{palabra}"\n'
+        f'repeticiones = {veces}\n'
+        f'resultado = palabraBase * repeticiones + "{sufijo}"\n'
+        f'print(len(resultado))'
+    )
+    largo = len(palabra) * veces + 1
+    distractores = [str(largo - 1), str(len(palabra) + veces + 1), str(largo + veces), str(len(palabra) * (veces + 1))]
+    explicacion = (f'"{palabra}" tiene {len(palabra)} caracteres; repetida {veces} veces suma {len(palabra) * veces}, '
+                   f'y el sufijo agrega 1 más: len devuelve {largo}.')
+    return codigo, "", "¿Qué imprime el siguiente código?", distractores, explicacion, \
+        ["manipulación de strings", "cálculos matemáticos simples"]
+
+def _plantilla_tipos(rng):
+    texto = str(_valor(rng, 10, 90))
+    extra = _valor(rng)
+    codigo = (
+        f'cantidadTexto = "{texto}"\n'
+        f'extra = {extra}\n'
+        f'suma = int(cantidadTexto) + extra\n'
+        f'union = cantidadTexto + str(extra)\n'
+        f'print(suma, union)'
+    )
+    suma = int(texto) + extra
+    distractores = [f"{texto}{extra} {suma}", f"{suma} {suma}", f"{texto}{extra} {texto}{extra}", f"{suma}{extra}"]
+    explicacion = (f"int convierte la cadena en número y se suma: {texto} + {extra} = {suma}. "
+                   f"str convierte el número en cadena y + concatena: \"{texto}{extra}\".")
+    return codigo, "", "¿Qué imprime el siguiente código?", distractores, explicacion, \
+        ["operaciones entre tipos distintos (int, float, str)", "concatenación de cadenas"]
+
+def _plantilla_intercambio(rng):
+    a = _valor(rng)
+    b = _valor(rng)
+    while b == a:
+        b = _valor(rng)
+    codigo = (
+        f'primerValor = {a}\n'
+        f'segundoValor = {b}\n'
+        f'auxiliar = primerValor\n'
+        f'primerValor = segundoValor\n'
+        f'segundoValor = auxiliar\n'
+        f'primerValor = primerValor - segundoValor\n'
+        f'print(primerValor, segundoValor)'
+    )
+    distractores = [f"{a - b} {b}", f"{b} {a}", f"{a - b} {a}", f"{b - a} {b}"]
+    explicacion = (f"Con la variable auxiliar se intercambian los valores: primerValor = {b} y segundoValor = {a}. "
+                   f"Luego primerValor pasa a {b} - {a} = {b - a}.")
+    return codigo, "", "¿Qué imprime el siguiente código?", distractores, explicacion, \
+        ["intercambio de valores entre variables", "cálculos matemáticos simples"]
+
+def _plantilla_area(rng):
+    base = _valor(rng, 3, 25)
+    altura = _valor(rng, 3, 25)
+    codigo = (
+        f'base = {base}\n'
+        f'alturaTriangulo = {altura}\n'
+        f'area = base * alturaTriangulo / 2\n'
+        f'print(area)'
+    )
+    distractores = [str(base * altura // 2), str(base * altura), str((base + altura) / 2), str(float(base * altura))]
+    explicacion = f"{base} * {altura} = {base * altura}; el operador / siempre devuelve float: {base * altura / 2}."
+    return codigo, "", "¿Qué imprime el siguiente código?", distractores, explicacion, \
+        ["altura", "cálculos matemáticos simples"]
+
+def _plantilla_precio(rng):
+    producto = rng.choice(_PRODUCTOS_LOCAL)
+    precio = rng.choice([4.5, 7.25, 12.8, 19.9, 3.75, 9.6, 14.4])
+    unidades = _valor(rng, 2, 20)
+    porcentaje = rng.choice([10, 20, 25, 50])
+    codigo = (
+        f'precioUnitario = {precio}\n'
+        f'unidades = int(input("Unidades de {producto}: "))\n'
+        f'subtotal = precioUnitario * unidades\n'
+        f'descuento = subtotal * {porcentaje} / 100\n'
+        f'print(round(subtotal - descuento, 2))'
+    )
+    subtotal = precio * unidades
+    descuento = subtotal * porcentaje / 100
+    distractores = [str(round(subtotal, 2)), str(round(descuento, 2)), str(round(subtotal + descuento, 2)),
+                    str(round(subtotal - porcentaje, 2))]
+    explicacion = (f"subtotal = {precio} * {unidades} = {round(subtotal, 2)}; el descuento es el {porcentaje}% "
+                   f"= {round(descuento, 2)}; se imprime la diferencia redondeada a 2 decimales.")
+    return codigo, f"{unidades}\n", f"Si el usuario ingresa {unidades}, ¿qué imprime el siguiente código?", \
+        distractores, explicacion, ["precio de producto", "operaciones entre tipos distintos (int, float, str)"]
+
+def _plantilla_edad(rng):
+    edad = rng.randint(11, 20)
+    codigo = (
+        'edadActual = int(input("Edad: "))\n'
+        'mesesVividos = edadActual * 12\n'
+        'decadas = edadActual // 10\n'
+        'print(mesesVividos, decadas)'
+    )
+    distractores = [f"{edad * 12} {edad / 10}", f"{edad * 10} {edad // 12}", f"{edad * 12} {edad % 10}",
+                    f"{edad}12 {edad // 10}"]
+    explicacion = f"{edad} * 12 = {edad * 12} y la división entera {edad} // 10 descarta los decimales: {edad // 10}."
+    return codigo, f"{edad}\n", f"Si el usuario ingresa {edad}, ¿qué imprime el siguiente código?", \
+        distractores, explicacion, ["edad", "cálculos matemáticos simples"]
+
+def _plantilla_peso(rng):
+    peso = rng.choice([48, 55, 61, 68, 74, 83, 91])
+    altura = rng.choice([1.55, 1.62, 1.68, 1.74, 1.8, 1.87])
+    codigo = (
+        f'pesoKg = {peso}\n'
+        f'alturaMetros = {altura}\n'
+        f'indice = pesoKg / (alturaMetros ** 2)\n'
+        f'print(round(indice, 1))'
+    )
+    indice = peso / (altura ** 2)
+    distractores = [str(round(peso / altura, 1)), str(round(peso / altura * 2, 1)), str(round(indice)),
+                    str(round(indice + 1, 1))]
+    explicacion = f"Primero se eleva la altura al cuadrado ({round(altura ** 2, 4)}) y luego se divide el peso: {round(indice, 1)}."
+    return codigo, "", "¿Qué imprime el siguiente código?", distractores, explicacion, \
+        ["peso", "altura"]
+
+def _plantilla_division(rng):
+    total = _valor(rng, 20, 99)
+    grupos = _valor(rng, 4, 9)
+    codigo = (
+        f'totalFichas = {total}\n'
+        f'jugadores = {grupos}\n'
+        f'porJugador = totalFichas // jugadores\n'
+        f'sobrantes = totalFichas % jugadores\n'
+        f'print(porJugador, sobrantes)'
+    )
+    distractores = [f"{round(total / grupos, 2)} {total % grupos}", f"{total % grupos} {total // grupos}",
+                    f"{total // grupos} {total // grupos}", f"{total // grupos + 1} {grupos - total % grupos}"]
+    explicacion = f"// da el cociente entero ({total // grupos}) y % el resto de la división ({total % grupos})."
+    return codigo, "", "¿Qué imprime el siguiente código?", distractores, explicacion, \
+        ["cálculos matemáticos simples", "intercambio de valores entre variables"]
+
+def _plantilla_codigo_texto(rng):
+    prefijo = rng.choice(_PALABRAS_LOCAL).upper()[:3]
+    numero = _valor(rng, 4, 60)
+    codigo = (
+        f'prefijo = "{prefijo}"\n'
+        f'numero = {numero}\n'
+        f'etiqueta = prefijo + "-" + str(numero * 2)\n'
+        f'print(etiqueta.lower())'
+    )
+    distractores = [f"{prefijo}-{numero * 2}", f"{prefijo.lower()}-{numero}{numero}", f"{prefijo.lower()}-{numero}2",
+                    f"{prefijo.lower()}{numero * 2}"]
+    explicacion = f"numero * 2 = {numero * 2}, str lo convierte para concatenarlo y lower() pasa todo a minúsculas."
+    return codigo, "", "¿Qué imprime el siguiente código?", distractores, explicacion, \
+        ["manipulación de strings", "operaciones entre tipos distintos (int, float, str)"]
+
+# (temática principal, plantilla)
+PLANTILLAS_LOCALES = [
+    ("concatenación de cadenas", _plantilla_concatenacion),
+    ("manipulación de strings", _plantilla_strings),
+    ("operaciones entre tipos distintos (int, float, str)", _plantilla_tipos),
+    ("intercambio de valores entre variables", _plantilla_intercambio),
+    ("altura", _plantilla_area),
+    ("precio de producto", _plantilla_precio),
+    ("edad", _plantilla_edad),
+    ("peso", _plantilla_peso),
+    ("cálculos matemáticos simples", _plantilla_division),
+    ("manipulación de strings", _plantilla_codigo_texto),
+]
+
+def ejecutar_plantilla(codigo, entrada):
+    """
+    Ejecuta en proceso un código generado por las plantillas (confiable) y devuelve lo que imprime.
+    """
+    salida = io.StringIO()
+    lineas = iter(entrada.splitlines())
+    entorno = {
+        "print": lambda *args, **kwargs: print(*args, **kwargs, file=salida),
+        "input": lambda mensaje="": next(lineas),
+    }
+    exec(compile(codigo, "<plantilla>", "exec"), entorno)
+    return salida.getvalue().rstrip("\n")
+
+def _desplazar_numeros(texto, desplazamiento, solo_ultimo=False):
+    """
+    Suma 'desplazamiento' a los números de la salida (o solo al último), conservando sus decimales.
+    """
+    numeros = list(re.finditer(r"-?\d+(?:\.\d+)?", texto))
+    if solo_ultimo:
+        numeros = numeros[-1:]
+    for coincidencia in reversed(numeros):
+        numero = coincidencia.group(0)
+        if "." in numero:
+            decimales = len(numero.split(".")[1])
+            nuevo = f"{float(numero) + desplazamiento:.{decimales}f}"
+        else:
+            nuevo = str(int(numero) + desplazamiento)
+        texto = texto[:coincidencia.start()] + nuevo + texto[coincidencia.end():]
+    return texto
+
+def distractores_respaldo(correcta):
+    """
+    Opciones de reserva cuando los distractores de una plantilla coinciden entre sí o con la
+    correcta: la salida real con sus números corridos (o, si no tiene números, con cambios
+    de mayúsculas y puntuación), para que ninguna opción delate a la correcta.
+    """
+    if re.search(r"\d", correcta):
+        return [_desplazar_numeros(correcta, desplazamiento, solo_ultimo)
+                for desplazamiento in (1, 2, -1, 10) for solo_ultimo in (True, False)]
+    return [correcta.upper(), correcta.lower(), correcta.replace(", ", ","), correcta.rstrip("!.?"),
+            correcta.replace(" ", "")]
+
+def generar_pregunta_local(rng=None, excluir=()):
+    """
+    Genera una pregunta con el mismo formato que las de Gemini, a partir de una plantilla al azar
+    cuya temática principal no esté en 'excluir' (si todas lo están, de cualquiera).
+    """
+    rng = rng or random
+    candidatas = [par for par in PLANTILLAS_LOCALES if par[0] not in excluir] or PLANTILLAS_LOCALES
+    tema, plantilla = rng.choice(candidatas)
+    codigo, entrada, enunciado, distractores, explicacion, tematicas = plantilla(rng)
+    correcta = ejecutar_plantilla(codigo, entrada)
+    opciones = [correcta]
+    for distractor in distractores + distractores_respaldo(correcta):
+        if len(opciones) == 4:
+            break
+        if distractor not in opciones:
+            opciones.append(distractor)
+    rng.shuffle(opciones)
+    return {
+        "pregunta": enunciado,
+        "codigo": codigo,
+        "respuestas": opciones,
+        "respuesta_correcta": correcta,
+        "explicacion": explicacion,
+        "tematicas_usadas": tematicas,
+        "tema": tema,
+        "origen": "local",
+    }
+
+# =============================
+# CONTROL DE RITMO DE GENERACIÓN
+# =============================
+class LimitadorAdaptativo:
+    """
+    Token bucket para las llamadas a Gemini cuyo ritmo se adapta a la cuota real:
+    crece poco a poco con cada éxito y se reduce a la mitad, con backoff
+    exponencial, ante cada RESOURCE_EXHAUSTED.
+    """
+    def __init__(self, rpm, rpm_max, rpm_min=1.0):
+        self.rpm = rpm
+        self.rpm_max = rpm_max
+        self.rpm_min = rpm_min
+        self.tokens = 1.0
+        self.ultimo = time.monotonic()
+        self.bloqueado_hasta = 0.0
+        self.fallos_seguidos = 0
+        self._lock = asyncio.Lock()
+
+    def _recargar(self):
+        ahora = time.monotonic()
+        capacidad = max(1.0, self.rpm / 60 * GEN_CONCURRENCIA)
+        self.tokens = min(capacidad, self.tokens + (ahora - self.ultimo) * self.rpm / 60)
+        self.ultimo = ahora
+
+    async def adquirir(self):
+        """
+        Espera hasta que haya un token disponible y no haya un backoff en curso.
+        """
+        async with self._lock:
+            while True:
+                self._recargar()
+                espera = self.bloqueado_hasta - time.monotonic()
+                if espera <= 0 and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                if espera <= 0:
+                    espera = (1 - self.tokens) * 60 / self.rpm
+                await asyncio.sleep(espera)
+
+    def exito(self):
+        """
+        Aumento aditivo del ritmo tras una llamada correcta.
+        """
+        self.fallos_seguidos = 0
+        self.rpm = min(self.rpm_max, self.rpm + 0.5)
+
+    def cuota_agotada(self, retraso=None):
+        """
+        Reducción multiplicativa del ritmo y backoff ante RESOURCE_EXHAUSTED.
+        Si la API indica cuánto esperar (retryDelay), se respeta ese valor.
+        """
+        self.fallos_seguidos += 1
+        self.rpm = max(self.rpm_min, self.rpm / 2)
+        if retraso is None:
+            retraso = min(60, 2 ** self.fallos_seguidos) + random.uniform(0, 1)
+        self.bloqueado_hasta = time.monotonic() + retraso
+        self.tokens = 0.0
+
+class MedidorRitmo:
+    """
+    Cuenta eventos en una ventana deslizante para informar un ritmo por minuto.
+    """
+    def __init__(self, ventana=60):
+        self.ventana = ventana
+        self.eventos = deque()
+
+    def registrar(self, cantidad=1):
+        ahora = time.monotonic()
+        self.eventos.append((ahora, cantidad))
+        self._purgar(ahora)
+
+    def _purgar(self, ahora):
+        while self.eventos and self.eventos[0][0] < ahora - self.ventana:
+            self.eventos.popleft()
+
+    def por_minuto(self):
+        self._purgar(time.monotonic())
+        return sum(cantidad for _, cantidad in self.eventos) * 60 / self.ventana
+
+# Plazo máximo de cada llamada a Gemini y parámetros del circuito
+GEMINI_TIMEOUT = float(os.getenv("GEMINI_TIMEOUT", "60"))
+CIRCUITO_FALLOS = int(os.getenv("CIRCUITO_FALLOS", "5"))  # Fallos seguidos que abren el circuito
+CIRCUITO_ESPERA = float(os.getenv("CIRCUITO_ESPERA", "30"))  # Segundos abierto antes de probar de nuevo
+CIRCUITO_ESPERA_MAX = float(os.getenv("CIRCUITO_ESPERA_MAX", "300"))
+
+class CircuitoAbierto(Exception):
+    """
+    La llamada a Gemini se rechazó sin intentarla porque el circuito está abierto.
+    """
+
+class CircuitoGemini:
+    """
+    Circuit breaker de las llamadas a Gemini:
+    - cerrado: las llamadas pasan; CIRCUITO_FALLOS fallos o timeouts seguidos lo abren.
+    - abierto: las llamadas se rechazan al instante durante la espera.
+    - semiabierto: pasa una sola llamada de prueba; si sale bien se cierra, si falla
+      se vuelve a abrir con el doble de espera (hasta CIRCUITO_ESPERA_MAX).
+    Solo el productor llama a Gemini, así que el estado local solo cambia en ese worker;
+    el productor lo publica en el banco en cada cambio y todos los workers (también el
+    productor) leen de ahí el estado compartido para degradar las rutas y para /estado.
+    """
+    def __init__(self, umbral, espera, espera_max, banco):
+        self.banco = banco
+        self.umbral = umbral
+        self.espera_base = espera
+        self.espera = espera
+        self.espera_max = espera_max
+        self.estado = "cerrado"
+        self.fallos_seguidos = 0
+        self.abierto_hasta = 0.0
+        self.prueba_en_curso = False
+        self.aperturas = 0
+        self.rechazadas = 0
+        self._publicado = None
+        # Último estado leído del banco y cuándo (monotónico) se leyó
+        self.compartido = self._instantanea()
+        self._leido = 0.0
+
+    def permitir(self):
+        """
+        Indica si la llamada puede hacerse; en semiabierto reserva la única llamada de prueba.
+        """
+        if self.estado == "abierto" and time.time() >= self.abierto_hasta:
+            self.estado = "semiabierto"
+        if self.estado == "cerrado":
+            return True
+        if self.estado == "semiabierto" and not self.prueba_en_curso:
+            self.prueba_en_curso = True
+            return True
+        self.rechazadas += 1
+        return False
+
+    def exito(self):
+        self.estado = "cerrado"
+        self.fallos_seguidos = 0
+        self.espera = self.espera_base
+        self.prueba_en_curso = False
+
+    def fallo(self):
+        self.fallos_seguidos += 1
+        if self.estado == "semiabierto":
+            self.espera = min(self.espera_max, self.espera * 2)
+            self._abrir()
+        elif self.estado == "cerrado" and self.fallos_seguidos >= self.umbral:
+            self._abrir()
+
+    def cancelada(self):
+        """
+        La llamada terminó sin resultado (tarea cancelada): libera la prueba del semiabierto.
+        """
+        self.prueba_en_curso = False
+
+    def _abrir(self):
+        self.estado = "abierto"
+        # Hora de reloj (no monotónica) porque la leen otros procesos
+        self.abierto_hasta = time.time() + self.espera
+        self.prueba_en_curso = False
+        self.aperturas += 1
+
+    def segundos_para_reintento(self):
+        if self.estado != "abierto":
+            return 0.0
+        return max(0.0, self.abierto_hasta - time.time())
+
+    def _instantanea(self):
+        return {
+            "estado": self.estado,
+            "fallos_seguidos": self.fallos_seguidos,
+            "abierto_hasta": self.abierto_hasta,
+            "aperturas": self.aperturas,
+            "rechazadas": self.rechazadas,
+        }
+
+    async def publicar(self, forzar=False):
+        """
+        Guarda el estado local en el banco si cambió desde la última publicación
+        (o siempre, con 'forzar', al tomar el rol de productor).
+        """
+        estado = self._instantanea()
+        clave = (estado["estado"], estado["fallos_seguidos"], estado["abierto_hasta"], estado["aperturas"])
+        if forzar or clave != self._publicado:
+            try:
+                await asyncio.to_thread(self.banco.guardar_circuito, estado)
+            except sqlite3.Error:
+                return  # Se reintenta en la próxima llamada
+            self._publicado = clave
+
+    async def actualizar_compartido(self, antiguedad=1.0):
+        """
+        Relee del banco el estado publicado por el productor, como mucho una vez por 'antiguedad' segundos.
+        """
+        if time.monotonic() - self._leido < antiguedad:
+            return self.compartido
+        estado = await asyncio.to_thread(self.banco.leer_circuito)
+        self.compartido = estado or self._instantanea()
+        self._leido = time.monotonic()
+        return self.compartido
+
+    def degradado(self):
+        """
+        Indica si Gemini está caído según el último estado compartido leído.
+        """
+        return self.compartido["estado"] != "cerrado"
+
+    def resumen(self):
+        estado = self.compartido
+        return {
+            "estado": estado["estado"],
+            "fallos_seguidos": estado["fallos_seguidos"],
+            "segundos_para_reintento": round(
+                max(0.0, estado["abierto_hasta"] - time.time()) if estado["estado"] == "abierto" else 0.0, 2),
+            "aperturas": estado["aperturas"],
+            "rechazadas": estado["rechazadas"],
+        }
+
+limitador_gemini = LimitadorAdaptativo(GEN_RPM, GEN_RPM_MAX)
+circuito_gemini = CircuitoGemini(CIRCUITO_FALLOS, CIRCUITO_ESPERA, CIRCUITO_ESPERA_MAX, banco)
+ritmo_generacion = MedidorRitmo()
+
+def extraer_retry_delay(error):
+    """
+    Devuelve los segundos de 'retryDelay' que informa un error de cuota de Gemini, si los hay.
+    """
+    coincidencia = re.search(r"retryDelay['\"]?\s*:\s*['\"]?(\d+(?:\.\d+)?)s", str(error))
+    return float(coincidencia.group(1)) if coincidencia else None
+
 # =============================
 # GENERACIÓN Y OBTENCIÓN DE PREGUNTAS
 # =============================
-def generar_pregunta(tematicas_previas=None):
+# Limita las llamadas simultáneas a Gemini de este worker (precarga + generación en caliente)
+semaforo_gemini = asyncio.Semaphore(GEN_CONCURRENCIA)
+
+async def llamar_gemini(contenido):
     """
-    Llama a Gemini para generar una pregunta nueva, pasando las temáticas previas.
-    Limpia el texto y lo convierte a un diccionario Python.
+    Hace una llamada a Gemini respetando el circuito, el semáforo de concurrencia, el limitador
+    de ritmo y el plazo GEMINI_TIMEOUT. Informa del resultado al limitador y al circuito, y
+    publica en el banco el estado del circuito si cambió.
+    Lanza CircuitoAbierto sin llamar si el circuito no lo permite.
     """
-    if tematicas_previas is None:
-        tematicas_previas = []
-    # Construye el prompt dinámicamente con las temáticas previas
-    tematicas_json = json.dumps(tematicas_previas, ensure_ascii=False)
-    instruccion_evitar = "## Importante: Evita usar cualquiera de las temáticas listadas en 'tematicas_previas' para generar esta nueva pregunta."
-    prompt_con_tematicas = f"{PROMPT}\n\n# tematicas_previas = {tematicas_json}\n\n{instruccion_evitar}\n"
-    response = client.models.generate_content(
-        model="gemini-2.5-flash-lite-preview-06-17", 
-        contents=prompt_con_tematicas
+    try:
+        return await _llamar_gemini(contenido)
+    finally:
+        await asyncio.shield(circuito_gemini.publicar())
+
+async def _llamar_gemini(contenido):
+    if not circuito_gemini.permitir():
+        m_gemini_errores.labels("circuito").inc()
+        raise CircuitoAbierto()
+    try:
+        await limitador_gemini.adquirir()
+        async with semaforo_gemini:
+            with cronometro(m_gemini_latencia):
+                response = await asyncio.wait_for(
+                    obtener_cliente().aio.models.generate_content(
+                        model="gemini-2.5-flash-lite-preview-06-17",
+                        contents=contenido,
+                        config=CONFIG_GENERACION
+                    ),
+                    timeout=GEMINI_TIMEOUT
+                )
+    except asyncio.TimeoutError:
+        m_gemini_errores.labels("timeout").inc()
+        circuito_gemini.fallo()
+        raise
+    except asyncio.CancelledError:
+        circuito_gemini.cancelada()
+        raise
+    except Exception as e:
+        if "RESOURCE_EXHAUSTED" in str(e):
+            # Gemini respondió: la cuota la maneja el limitador, no el circuito
+            m_gemini_errores.labels("cuota").inc()
+            limitador_gemini.cuota_agotada(extraer_retry_delay(e))
+            circuito_gemini.exito()
+        else:
+            m_gemini_errores.labels("otro").inc()
+            circuito_gemini.fallo()
+        raise
+    circuito_gemini.exito()
+    limitador_gemini.exito()
+    registrar_tokens(response)
+    return response
+
+def registrar_tokens(response):
+    """
+    Registra los tokens de entrada (y cuántos vinieron de cache), salida y total de cada llamada.
+    """
+    uso = getattr(response, "usage_metadata", None)
+    if uso is None:
+        return
+    for tipo, valor in (("entrada", uso.prompt_token_count), ("salida", uso.candidates_token_count),
+                        ("cache", getattr(uso, "cached_content_token_count", None)),
+                        ("total", uso.total_token_count)):
+        if valor:
+            m_gemini_tokens.labels(tipo).observe(valor)
+
+# El prompt fijo viaja como instrucción de sistema (idéntica en todas las llamadas, lo que
+# permite a Gemini cachear ese prefijo) y la salida se restringe con un esquema JSON:
+# cada petición solo envía las temáticas previas y la cantidad de preguntas.
+ESQUEMA_PREGUNTAS = types.Schema(
+    type="ARRAY",
+    items=types.Schema(
+        type="OBJECT",
+        properties={
+            "Codigo": types.Schema(type="STRING"),
+            "Pregunta": types.Schema(type="STRING"),
+            "Respuesta correcta": types.Schema(type="STRING"),
+            "Respuestas": types.Schema(type="ARRAY", items=types.Schema(type="STRING"), min_items=4, max_items=4),
+            "Explicacion": types.Schema(type="STRING"),
+            "tematicas_usadas": types.Schema(type="ARRAY", items=types.Schema(type="STRING")),
+        },
+        required=["Codigo", "Pregunta", "Respuesta correcta", "Respuestas", "Explicacion", "tematicas_usadas"],
+        property_ordering=["Codigo", "Pregunta", "Respuesta correcta", "Respuestas", "Explicacion", "tematicas_usadas"],
+    ),
+)
+CONFIG_GENERACION = types.GenerateContentConfig(
+    system_instruction=PROMPT,
+    response_mime_type="application/json",
+    response_schema=ESQUEMA_PREGUNTAS,
+)
+
+def construir_prompt(tema=None, cantidad=1):
+    """
+    Arma la parte variable de la petición: temática principal pedida y cantidad de preguntas del array.
+    """
+    if tema is None or tema == TEMA_OTRAS:
+        indicacion = "Elige la temática principal al azar entre las posibles."
+    else:
+        indicacion = (f"Temática principal obligatoria para todos los ejercicios: '{tema}'. "
+                      f"Usa una temática secundaria distinta en cada uno.")
+    return (
+        f"{indicacion} Genera {cantidad} ejercicios distintos entre sí, "
+        f"como array JSON de {cantidad} objetos."
     )
+
+async def generar_lote_preguntas(cantidad, tema=None):
+    """
+    Pide 'cantidad' preguntas de una temática en una sola llamada a Gemini y devuelve solo las válidas.
+    """
+    response = await llamar_gemini(construir_prompt(tema, cantidad))
+    preguntas = [p for p in parsear_preguntas(response.text) if es_pregunta_valida(p)]
+    m_preguntas_generadas.inc(len(preguntas))
+    return preguntas
+
+def normalizar_pregunta(pregunta_json):
+    """
+    Convierte un objeto JSON de Gemini al diccionario de pregunta usado por la app.
+    """
+    return {
+        "pregunta": pregunta_json.get("Pregunta"),
+        "codigo": pregunta_json.get("Codigo"),
+        "respuestas": pregunta_json.get("Respuestas") or [],
+        "respuesta_correcta": pregunta_json.get("Respuesta correcta"),
+        "explicacion": pregunta_json.get("Explicacion", ""),
+        "tematicas_usadas": pregunta_json.get("tematicas_usadas", [])
+    }
+
+def parsear_preguntas(texto):
+    """
+    Convierte la respuesta estructurada de Gemini (array JSON según ESQUEMA_PREGUNTAS) en una lista de preguntas.
+    """
+    try:
+        datos = json.loads(texto)
+    except (TypeError, ValueError):
+        # Con esquema de respuesta solo ocurre si la salida se cortó (límite de tokens)
+        m_json_invalido.inc()
+        return []
+    return [normalizar_pregunta(d) for d in datos if isinstance(d, dict)]
+
+async def obtener_pregunta_cache_async(temas_vistos=()):
+    """
+    Obtiene una pregunta del cache sin esperar (ni ocupar hilos del executor),
+    preferentemente de una temática que la sesión todavía no vio.
+    Si el cache está vacío usa al instante el generador local de respaldo en vez
+    de llamar a Gemini dentro de la petición; con el circuito de Gemini abierto
+    primero recicla una pregunta de Gemini ya servida.
+    """
+    planificador.registrar_consumo()
+    with cronometro(m_cache_espera):
+        pregunta = await tomar_pregunta_cache(temas_vistos)
+        if pregunta is not None and es_pregunta_valida(pregunta):
+            m_cache.labels("acierto").inc()
+            return pregunta
+        m_cache.labels("fallo").inc()
+        await circuito_gemini.actualizar_compartido()
+        if circuito_gemini.degradado():
+            pregunta = await asyncio.to_thread(banco.obtener_reciclada, temas_vistos)
+            if pregunta is not None and es_pregunta_valida(pregunta):
+                m_respaldo.labels("reciclada").inc()
+                recordar_pregunta(pregunta)
+                return pregunta
+        m_respaldo.labels("local").inc()
+        return await generar_pregunta_respaldo(temas_vistos)
+
+async def tomar_pregunta_cache(temas_vistos=()):
+    """
+    Saca una pregunta del inventario, si hay, y la marca como servida en el banco.
+    Descarta las que otro worker ya sirvió tras expirar su reserva.
+    Devuelve None si el cache está vacío.
+    """
+    while True:
+        pregunta = pregunta_cache.tomar(temas_vistos)
+        if pregunta is None:
+            evento_reponer.set()
+            return None
+        if pregunta_cache.qsize() < CACHE_LOCAL // 2:
+            evento_reponer.set()
+        if not isinstance(pregunta, dict) or "id" not in pregunta:
+            return pregunta
+        if await asyncio.to_thread(banco.marcar_servida, pregunta["id"]):
+            recordar_pregunta(pregunta)
+            return pregunta
+
+async def generar_pregunta_respaldo(temas_vistos=()):
+    """
+    Genera una pregunta con las plantillas locales y la registra en el banco como ya servida,
+    para que la sesión pueda referenciarla por id.
+    """
+    pregunta = generar_pregunta_local(excluir=temas_vistos)
+    await asyncio.to_thread(banco.agregar_lote, [pregunta], True)
+    recordar_pregunta(pregunta)
+    return pregunta
+
+# Preguntas servidas recientemente, para resolver por id las referencias de las sesiones
+cache_preguntas = LRUCache(maxsize=int(os.getenv("CACHE_PREGUNTAS_SESION", "5000")))
+
+def recordar_pregunta(pregunta):
+    """
+    Guarda la pregunta servida en el LRU de preguntas referenciadas por las sesiones.
+    """
+    cache_preguntas[pregunta["id"]] = pregunta
+
+async def cargar_pregunta(id_pregunta):
+    """
+    Resuelve el id de pregunta de una sesión: primero en el LRU, luego en el banco.
+    """
+    pregunta = cache_preguntas.get(id_pregunta)
+    if pregunta is None:
+        pregunta = await asyncio.to_thread(banco.obtener, id_pregunta)
+        if pregunta is not None:
+            cache_preguntas[id_pregunta] = pregunta
+    return pregunta
+
+# =============================
+# DEDUPLICACIÓN DE PREGUNTAS
+# =============================
+DEDUP_MAX = int(os.getenv("DEDUP_MAX", "50000"))  # Preguntas recientes que recuerda el índice
+DEDUP_UMBRAL = float(os.getenv("DEDUP_UMBRAL", "0.8"))  # Similitud Jaccard a partir de la cual es casi duplicada
+
+_NOMBRES_RESERVADOS = set(keyword.kwlist) | set(dir(builtins))
+_PRIMO_MINHASH = (1 << 61) - 1
+
+def tokens_normalizados(codigo):
+    """
+    Tokeniza el código quitando comentarios y espacios, y renombrando las variables
+    por orden de aparición (v0, v1, ...) para que el nombre elegido no cuente.
+    """
+    nombres = {}
+    tokens = []
     try:
-        text = response.text.strip()
-        # Limpia el texto de bloques de código Markdown
-        if text.startswith("```json"):
-            text = text[7:]
-        if text.startswith("```"):
-            text = text[3:]
-        if text.endswith("```"):
-            text = text[:-3]
-        pregunta_json = json.loads(text)
-        # Validación de la estructura del JSON
-        respuestas = pregunta_json.get("Respuestas")
-        if isinstance(respuestas, str):
-            respuestas = [r.strip() for r in respuestas.split(",")]
-        elif not isinstance(respuestas, list):
-            respuestas = []
-        pregunta = {
-            "pregunta": pregunta_json.get("Pregunta"),
-            "codigo": pregunta_json.get("Codigo"),
-            "respuestas": respuestas,
-            "respuesta_correcta": pregunta_json.get("Respuesta correcta"),
-            "explicacion": pregunta_json.get("Explicacion", ""),
-            "tematicas_usadas": pregunta_json.get("tematicas_usadas", [])
+        for tok in tokenize.generate_tokens(io.StringIO(codigo).readline):
+            if tok.type in (tokenize.COMMENT, tokenize.NL, tokenize.NEWLINE, tokenize.INDENT,
+                            tokenize.DEDENT, tokenize.ENDMARKER):
+                continue
+            texto = tok.string
+            if tok.type == tokenize.NAME and texto not in _NOMBRES_RESERVADOS:
+                texto = nombres.setdefault(texto, f"v{len(nombres)}")
+            elif tok.type == tokenize.STRING:
+                texto = texto.lower()
+            tokens.append(texto)
+    except (tokenize.TokenError, IndentationError, SyntaxError):
+        tokens = re.findall(r"\w+|\S", codigo.lower())
+    return tokens
+
+def hash64(texto):
+    return int.from_bytes(hashlib.blake2b(texto.encode("utf-8"), digest_size=8).digest(), "big", signed=True)
+
+class IndiceDuplicados:
+    """
+    Índice compacto para rechazar preguntas repetidas al insertarlas.
+    - Duplicado exacto: mismo código normalizado y mismas respuestas (hash de 64 bits).
+    - Casi duplicado: firma MinHash de shingles de 3 tokens, buscada con LSH por bandas;
+      se rechaza si la similitud estimada supera DEDUP_UMBRAL.
+    Guarda solo enteros en arrays y diccionarios, y olvida las preguntas más antiguas
+    al superar DEDUP_MAX, por lo que ocupa pocos MB con decenas de miles de preguntas.
+    """
+    PERMUTACIONES = 32
+    BANDAS = 4
+
+    def __init__(self, maximo=DEDUP_MAX, umbral=DEDUP_UMBRAL):
+        self.maximo = maximo
+        self.umbral = umbral
+        self.filas = self.PERMUTACIONES // self.BANDAS
+        aleatorio = random.Random(1234)
+        self._a = [aleatorio.randrange(1, _PRIMO_MINHASH) for _ in range(self.PERMUTACIONES)]
+        self._b = [aleatorio.randrange(0, _PRIMO_MINHASH) for _ in range(self.PERMUTACIONES)]
+        self._exactas = {}  # hash exacto -> posición
+        self._bandas = {}   # hash de banda -> posición
+        self._firmas = array("I")  # Firmas de 32 bits, contiguas; crece hasta 'maximo' posiciones
+        self._claves = [None] * maximo  # (hash exacto, hashes de banda) de cada posición
+        self._siguiente = 0
+        self.evaluadas = 0
+        self.duplicadas_exactas = 0
+        self.casi_duplicadas = 0
+
+    def _huella_exacta(self, pregunta, tokens):
+        respuestas = sorted(str(r).strip().lower() for r in pregunta.get("respuestas", []))
+        return hash64(" ".join(tokens) + "\x00" + "\x00".join(respuestas))
+
+    def _firma(self, tokens):
+        shingles = {hash64(" ".join(tokens[i:i + 3])) for i in range(max(1, len(tokens) - 2))}
+        return [min((a * x + b) % _PRIMO_MINHASH for x in shingles) & 0xFFFFFFFF for a, b in zip(self._a, self._b)]
+
+    def _hashes_banda(self, firma):
+        return [hash((i,) + tuple(firma[i * self.filas:(i + 1) * self.filas])) for i in range(self.BANDAS)]
+
+    def _similitud(self, firma, posicion):
+        inicio = posicion * self.PERMUTACIONES
+        iguales = sum(1 for i, v in enumerate(firma) if self._firmas[inicio + i] == v)
+        return iguales / self.PERMUTACIONES
+
+    def es_duplicada(self, pregunta, registrar=True):
+        """
+        Indica si la pregunta repite otra ya indexada. Si no lo es y registrar=True, la agrega al índice.
+        """
+        tokens = tokens_normalizados(pregunta.get("codigo") or "")
+        exacta = self._huella_exacta(pregunta, tokens)
+        self.evaluadas += 1
+        if exacta in self._exactas:
+            self.duplicadas_exactas += 1
+            return True
+        firma = self._firma(tokens)
+        bandas = self._hashes_banda(firma)
+        for clave in bandas:
+            posicion = self._bandas.get(clave)
+            if posicion is not None and self._similitud(firma, posicion) >= self.umbral:
+                self.casi_duplicadas += 1
+                return True
+        if registrar:
+            self._agregar(exacta, firma, bandas)
+        return False
+
+    def _agregar(self, exacta, firma, bandas):
+        posicion = self._siguiente % self.maximo
+        anterior = self._claves[posicion]
+        if anterior is not None:
+            # Olvida la pregunta más antigua que ocupaba esta posición
+            exacta_vieja, bandas_viejas = anterior
+            if self._exactas.get(exacta_vieja) == posicion:
+                del self._exactas[exacta_vieja]
+            for clave in bandas_viejas:
+                if self._bandas.get(clave) == posicion:
+                    del self._bandas[clave]
+        inicio = posicion * self.PERMUTACIONES
+        if inicio == len(self._firmas):
+            self._firmas.extend(firma)
+        else:
+            self._firmas[inicio:inicio + self.PERMUTACIONES] = array("I", firma)
+        self._exactas[exacta] = posicion
+        for clave in bandas:
+            self._bandas[clave] = posicion
+        self._claves[posicion] = (exacta, bandas)
+        self._siguiente += 1
+
+    def filtrar(self, preguntas):
+        """
+        Devuelve solo las preguntas nuevas (también descarta repetidas dentro del mismo lote).
+        No las indexa: eso lo hace registrar() con las que finalmente se guardan.
+        """
+        del_lote = IndiceDuplicados(maximo=max(1, len(preguntas)), umbral=self.umbral)
+        nuevas = [p for p in preguntas if not self.es_duplicada(p, registrar=False) and not del_lote.es_duplicada(p)]
+        self.duplicadas_exactas += del_lote.duplicadas_exactas
+        self.casi_duplicadas += del_lote.casi_duplicadas
+        return nuevas
+
+    def registrar(self, preguntas):
+        """
+        Indexa las preguntas que se guardaron en el banco.
+        """
+        for pregunta in preguntas:
+            tokens = tokens_normalizados(pregunta.get("codigo") or "")
+            firma = self._firma(tokens)
+            self._agregar(self._huella_exacta(pregunta, tokens), firma, self._hashes_banda(firma))
+
+    def cargar(self, preguntas):
+        """
+        Indexa preguntas ya existentes (por ejemplo, las del banco al arrancar) sin contarlas en las estadísticas.
+        """
+        for pregunta in preguntas:
+            self.es_duplicada(pregunta)
+        self.evaluadas = self.duplicadas_exactas = self.casi_duplicadas = 0
+
+    def tasa_duplicadas(self):
+        if not self.evaluadas:
+            return 0.0
+        return (self.duplicadas_exactas + self.casi_duplicadas) / self.evaluadas
+
+indice_duplicados = IndiceDuplicados()
+
+# =============================
+# VERIFICACIÓN POR EJECUCIÓN
+# =============================
+VERIF_CONCURRENCIA = int(os.getenv("VERIF_CONCURRENCIA", str(os.cpu_count() or 2)))  # Subprocesos simultáneos
+VERIF_TIMEOUT = 3  # Segundos de reloj por ejecución
+VERIF_CPU = 2  # Segundos de CPU por ejecución
+VERIF_MEMORIA = 256 * 1024 * 1024  # Bytes de memoria virtual por ejecución
+
+# Envoltorio del sandbox: limita CPU, memoria, escritura a disco y archivos abiertos (en el propio
+# hijo, sin preexec_fn, que puede trabar el fork en un proceso con hilos) e input() lee de stdin
+# sin imprimir el mensaje, como lo ve el enunciado
+_SANDBOX = (
+    "import builtins, sys\n"
+    "try:\n"
+    "    import resource\n"
+    "except ImportError:\n"
+    "    resource = None\n"
+    "if resource is not None:\n"
+    f"    resource.setrlimit(resource.RLIMIT_CPU, ({VERIF_CPU}, {VERIF_CPU}))\n"
+    f"    resource.setrlimit(resource.RLIMIT_AS, ({VERIF_MEMORIA}, {VERIF_MEMORIA}))\n"
+    "    resource.setrlimit(resource.RLIMIT_FSIZE, (0, 0))\n"
+    "    resource.setrlimit(resource.RLIMIT_NOFILE, (32, 32))\n"
+    "builtins.input = lambda mensaje='': sys.stdin.readline().rstrip('\\n')\n"
+    "codigo = sys.argv[1]\n"
+    "del sys.argv\n"
+    "exec(compile(codigo, '<ejercicio>', 'exec'), {'__name__': '__main__'})\n"
+)
+_NOMBRES_PROHIBIDOS = {"open", "exec", "eval", "compile", "__import__", "globals", "locals", "vars",
+                       "getattr", "setattr", "delattr", "breakpoint", "exit", "quit", "help", "memoryview"}
+
+def codigo_seguro(arbol):
+    """
+    Rechaza imports, accesos a atributos internos (__x__) y funciones que escapan del sandbox.
+    """
+    for nodo in ast.walk(arbol):
+        if isinstance(nodo, (ast.Import, ast.ImportFrom)):
+            return False
+        if isinstance(nodo, ast.Attribute) and nodo.attr.startswith("_"):
+            return False
+        if isinstance(nodo, ast.Name) and (nodo.id in _NOMBRES_PROHIBIDOS or nodo.id.startswith("__")):
+            return False
+    return True
+
+def valores_input(pregunta, arbol):
+    """
+    Deduce los valores que recibe cada input() a partir del enunciado.
+    Prueba los valores entre comillas y los números en orden de aparición (en ese orden):
+    devuelve la lista de textos para stdin de cada heurística que alcance para todos los
+    input(), [""] si no hay input(), o una lista vacía si no se pueden determinar.
+    """
+    llamadas = sum(
+        1 for nodo in ast.walk(arbol)
+        if isinstance(nodo, ast.Call) and isinstance(nodo.func, ast.Name) and nodo.func.id == "input"
+    )
+    if llamadas == 0:
+        return [""]
+    enunciado = pregunta.get("pregunta") or ""
+    citados = re.findall(r"[\"'“«]([^\"'”»]+)[\"'”»]", enunciado)
+    numeros = re.findall(r"(?<![\w.])-?\d+(?:\.\d+)?(?![\w.])", enunciado)
+    entradas = []
+    for candidatos in (citados, numeros):
+        if len(candidatos) == llamadas:
+            entrada = "".join(f"{valor}\n" for valor in candidatos)
+            if entrada not in entradas:
+                entradas.append(entrada)
+    return entradas
+
+def normalizar_salida(texto):
+    """
+    Compara salidas sin importar espacios, saltos de línea ni comillas externas.
+    """
+    texto = str(texto).strip()
+    if len(texto) >= 2 and texto[0] == texto[-1] and texto[0] in "\"'":
+        texto = texto[1:-1]
+    return " ".join(texto.split())
+
+class CacheVerificaciones(ConexionesSQLite):
+    """
+    Resultados de ejecución por hash de código y entradas, para no ejecutar dos veces el mismo fragmento.
+    """
+    def __init__(self, ruta):
+        super().__init__(ruta)
+        self._memoria = LRUCache(maxsize=10000)
+        # Se usa desde varios hilos del executor a la vez y LRUCache no es thread-safe
+        self._lock_memoria = threading.Lock()
+        self._conexion().execute(
+            "CREATE TABLE IF NOT EXISTS verificaciones (huella INTEGER PRIMARY KEY, salida TEXT, error TEXT)"
+        )
+
+    def obtener(self, huella):
+        with self._lock_memoria:
+            resultado = self._memoria.get(huella)
+        if resultado is None:
+            fila = self._conexion().execute(
+                "SELECT salida, error FROM verificaciones WHERE huella = ?", (huella,)
+            ).fetchone()
+            if fila is not None:
+                resultado = fila
+                with self._lock_memoria:
+                    self._memoria[huella] = fila
+        return resultado
+
+    def guardar(self, huella, salida, error):
+        with self._lock_memoria:
+            self._memoria[huella] = (salida, error)
+        self._conexion().execute(
+            "INSERT OR REPLACE INTO verificaciones (huella, salida, error) VALUES (?, ?, ?)",
+            (huella, salida, error)
+        )
+
+class VerificadorEjecucion:
+    """
+    Ejecuta el código de cada pregunta en un subproceso de Python aislado (-I -S, sin entorno,
+    en un directorio temporal y con límites de CPU, memoria y archivos) con los valores de
+    input() del enunciado, y compara la salida con la respuesta correcta.
+    Si la salida coincide con otra opción corrige la respuesta; si no coincide con ninguna
+    descarta la pregunta. Un semáforo acota los subprocesos simultáneos.
+    """
+    def __init__(self, cache, concurrencia=VERIF_CONCURRENCIA):
+        self.cache = cache
+        self.semaforo = asyncio.Semaphore(concurrencia)
+        self.estadisticas = {
+            "correctas": 0, "corregidas": 0, "descartadas": 0,
+            "no_verificables": 0, "ejecuciones": 0, "aciertos_cache": 0,
         }
-        if not es_pregunta_valida(pregunta):
-            return {"error": "Pregunta inválida o incompleta", "detalle": "Faltan campos o formato incorrecto", "texto": text}
-        return pregunta
-    except Exception as e:
-        return {"error": "No se pudo extraer el JSON", "detalle": str(e), "texto": response.text}
 
-async def obtener_pregunta_cache_async(tematicas_previas=None):
+    async def _ejecutar(self, codigo, entrada):
+        """
+        Devuelve (salida, error) de ejecutar el código; error es el nombre de la excepción,
+        "Timeout" o "Salida N" si el proceso terminó sin traceback (p. ej. matado por una señal).
+        Solo se guardan en el cache las ejecuciones normales y las excepciones de Python: un
+        timeout o una muerte por señal pueden ser transitorios.
+        """
+        huella = hash64(codigo + "\x00" + entrada)
+        resultado = await asyncio.to_thread(self.cache.obtener, huella)
+        if resultado is not None:
+            self.estadisticas["aciertos_cache"] += 1
+            return resultado
+        async with self.semaforo:
+            self.estadisticas["ejecuciones"] += 1
+            with tempfile.TemporaryDirectory() as directorio:
+                proceso = await asyncio.create_subprocess_exec(
+                    sys.executable, "-I", "-S", "-c", _SANDBOX, codigo,
+                    stdin=asyncio.subprocess.PIPE,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE,
+                    cwd=directorio,
+                    env={},
+                )
+                try:
+                    salida, errores = await asyncio.wait_for(
+                        proceso.communicate(entrada.encode("utf-8")), timeout=VERIF_TIMEOUT
+                    )
+                except asyncio.TimeoutError:
+                    proceso.kill()
+                    await proceso.wait()
+                    return "", "Timeout"
+        error = None
+        if proceso.returncode != 0:
+            ultima = errores.decode("utf-8", "replace").strip().splitlines()
+            if proceso.returncode < 0 or not ultima:
+                return salida.decode("utf-8", "replace"), f"Salida {proceso.returncode}"
+            error = ultima[-1].split(":")[0].strip()
+        resultado = (salida.decode("utf-8", "replace"), error)
+        await asyncio.to_thread(self.cache.guardar, huella, *resultado)
+        return resultado
+
+    @staticmethod
+    def _comparador(salida, error):
+        """
+        Función que indica si una opción coincide con el resultado de la ejecución.
+        """
+        if error:
+            # La salida esperada es el error: vale la opción que nombre la excepción
+            return lambda opcion: error.lower() in str(opcion).lower()
+        esperada = normalizar_salida(salida)
+        return lambda opcion: normalizar_salida(opcion) == esperada
+
+    async def verificar(self, pregunta):
+        """
+        Devuelve la pregunta (quizá con la respuesta corregida) o None si debe descartarse.
+        """
+        try:
+            arbol = ast.parse(pregunta["codigo"])
+        except SyntaxError:
+            self.estadisticas["descartadas"] += 1
+            return None
+        if not codigo_seguro(arbol):
+            self.estadisticas["descartadas"] += 1
+            return None
+        entradas = valores_input(pregunta, arbol)
+        if not entradas:
+            self.estadisticas["no_verificables"] += 1
+            return pregunta
+        coincidencias = []
+        for entrada in entradas:
+            salida, error = await self._ejecutar(pregunta["codigo"], entrada)
+            coincide = self._comparador(salida, error)
+            if error != "Timeout" and coincide(pregunta["respuesta_correcta"]):
+                self.estadisticas["correctas"] += 1
+                pregunta["verificada"] = True
+                return pregunta
+            coincidencias.append((error, tuple(coincide(opcion) for opcion in pregunta["respuestas"])))
+        if len(set(coincidencias)) > 1:
+            # Las heurísticas de input() no coinciden: no se sabe qué valores quiso decir el enunciado
+            self.estadisticas["no_verificables"] += 1
+            return pregunta
+        if error == "Timeout":
+            self.estadisticas["descartadas"] += 1
+            return None
+        opciones = [opcion for opcion in pregunta["respuestas"] if coincide(opcion)]
+        if len(opciones) == 1:
+            self.estadisticas["corregidas"] += 1
+            pregunta["respuesta_correcta"] = opciones[0]
+            pregunta["verificada"] = True
+            return pregunta
+        self.estadisticas["descartadas"] += 1
+        return None
+
+    async def verificar_lote(self, preguntas):
+        """
+        Verifica un lote en paralelo y devuelve solo las preguntas que se conservan.
+        """
+        resultados = await asyncio.gather(*(self.verificar(p) for p in preguntas), return_exceptions=True)
+        conservadas = []
+        for pregunta, resultado in zip(preguntas, resultados):
+            if isinstance(resultado, Exception):
+                # Un fallo del propio sandbox no descarta la pregunta: queda sin verificar
+                self.estadisticas["no_verificables"] += 1
+                conservadas.append(pregunta)
+            elif resultado is not None:
+                conservadas.append(resultado)
+        return conservadas
+
+verificador = VerificadorEjecucion(CacheVerificaciones(DB_PATH))
+
+# =============================
+# PLANIFICACIÓN DE LA REPOSICIÓN SEGÚN DEMANDA
+# =============================
+class PlanificadorReposicion:
+    """
+    Estima la demanda con una media móvil exponencial (EWMA) de las preguntas
+    servidas por todos los workers, predice cuánto falta para vaciar el banco
+    y a partir de eso fija el objetivo de reposición y cuántos generadores
+    trabajan. Generadores y planificador duermen sobre una condición en lugar
+    de consultar el banco periódicamente. Cada lote se pide para la temática
+    con menos stock, para que el banco quede balanceado.
+    """
+    def __init__(self, alfa=0.3):
+        self.alfa = alfa
+        self.tasa = 0.0  # Preguntas consumidas por segundo (EWMA)
+        self.disponibles = 0
+        self.en_vuelo = 0  # Preguntas pedidas a Gemini cuyo resultado todavía no llegó
+        self.disponibles_por_tema = dict.fromkeys(TEMATICAS, 0)
+        self.en_vuelo_por_tema = dict.fromkeys(TEMATICAS, 0)
+        self.objetivo = CACHE_MIN
+        self.concurrencia = 1
+        self.consumo_local = 0
+        self.condicion = asyncio.Condition()
+        self.evento_consumo = asyncio.Event()
+        self._ultima_muestra = time.time()
+
+    def registrar_consumo(self):
+        """
+        Lo llaman quiz_get/quiz_post (vía obtener_pregunta_cache_async) al consumir una pregunta.
+        Despierta al planificador para que recalcule antes de su próxima muestra.
+        """
+        self.consumo_local += 1
+        self.evento_consumo.set()
+
+    def segundos_hasta_vaciar(self):
+        if self.tasa <= 0:
+            return None
+        return self.disponibles / self.tasa
+
+    def actualizar(self, servidas, disponibles_por_tema, segundos):
+        """
+        Incorpora una muestra del banco y recalcula el objetivo y la concurrencia.
+        """
+        if segundos > 0:
+            self.tasa = self.alfa * (servidas / segundos) + (1 - self.alfa) * self.tasa
+        self.disponibles = sum(disponibles_por_tema.values())
+        self.disponibles_por_tema = {tema: disponibles_por_tema.get(tema, 0) for tema in TEMATICAS}
+        self.objetivo = int(min(CACHE_SIZE, max(CACHE_MIN, self.tasa * HORIZONTE_DEMANDA)))
+        restante = self.segundos_hasta_vaciar()
+        if restante is None:
+            urgencia = 0.0
+        else:
+            urgencia = 1 - min(1.0, restante / HORIZONTE_DEMANDA)
+        # Un banco muy por debajo del objetivo es urgente aunque todavía no haya demanda (arranque en frío)
+        deficit = max(0.0, (self.objetivo - self.disponibles) / self.objetivo)
+        urgencia = max(urgencia, deficit)
+        self.concurrencia = max(1, math.ceil(urgencia * GEN_CONCURRENCIA))
+
+    def faltantes(self):
+        return self.objetivo - self.disponibles - self.en_vuelo
+
+    def tema_mas_escaso(self):
+        """
+        Temática con menos preguntas disponibles más en vuelo, relativo a su peso en PESO_TEMATICA.
+        """
+        return min(
+            TEMATICAS,
+            key=lambda tema: (self.disponibles_por_tema[tema] + self.en_vuelo_por_tema[tema]) / PESO_TEMATICA[tema],
+        )
+
+    def proxima_espera(self):
+        """
+        Segundos hasta la próxima muestra: lo que tardaría la demanda actual en
+        bajar el banco del objetivo, acotado entre 1 y 10 segundos.
+        """
+        if self.disponibles < self.objetivo:
+            return 5
+        if self.tasa <= 0:
+            return 10
+        return max(1.0, min(10.0, (self.disponibles - self.objetivo) / self.tasa))
+
+    async def muestrear(self):
+        """
+        Lee del banco el consumo global desde la muestra anterior y avisa a los generadores.
+        """
+        ahora = time.time()
+        segundos = ahora - self._ultima_muestra
+        disponibles = await asyncio.to_thread(banco.contar_disponibles_por_tema)
+        if segundos >= 1:
+            # Ventanas más cortas darían picos de tasa sin sentido
+            servidas = await asyncio.to_thread(banco.contar_servidas, self._ultima_muestra)
+            self._ultima_muestra = ahora
+        else:
+            servidas, segundos = 0, 0
+        self.actualizar(servidas, disponibles, segundos)
+        async with self.condicion:
+            self.condicion.notify_all()
+
+    async def esperar_trabajo(self, indice):
+        """
+        Bloquea al generador 'indice' hasta que esté habilitado por la concurrencia
+        actual y falten preguntas; devuelve cuántas pedir y de qué temática.
+        """
+        async with self.condicion:
+            await self.condicion.wait_for(lambda: indice < self.concurrencia and self.faltantes() > 0)
+            cantidad = max(1, min(PREGUNTAS_POR_LLAMADA, self.faltantes()))
+            tema = self.tema_mas_escaso()
+            self.en_vuelo += cantidad
+            self.en_vuelo_por_tema[tema] += cantidad
+            return cantidad, tema
+
+    async def lote_terminado(self, tema, pedidas, lote):
+        """
+        Descuenta el lote en vuelo y suma al stock las preguntas persistidas, según su temática real.
+        """
+        async with self.condicion:
+            self.en_vuelo -= pedidas
+            self.en_vuelo_por_tema[tema] -= pedidas
+            for pregunta in lote:
+                tema_real = pregunta.get("tema")
+                if tema_real in self.disponibles_por_tema:
+                    self.disponibles_por_tema[tema_real] += 1
+                self.disponibles += 1
+            self.condicion.notify_all()
+
+planificador = PlanificadorReposicion()
+
+# =============================
+# TAREA DE PRECARGA DE PREGUNTAS
+# =============================
+async def precargar_preguntas():
     """
-    Obtiene una pregunta del cache de forma no bloqueante para el event loop.
-    Si el cache está vacío, genera una pregunta en caliente.
+    Productor único: mantiene el banco compartido al nivel que pide la demanda.
+    Lanza hasta GEN_CONCURRENCIA generadores, que el planificador habilita
+    según la urgencia, y muestrea el banco cuando hay consumo o al vencer la
+    espera prevista.
     """
-    loop = asyncio.get_running_loop()
+    # Indexa las preguntas existentes (de la más antigua a la más reciente) antes de generar nuevas
+    recientes = await asyncio.to_thread(lambda: list(banco.iterar_recientes_gemini(DEDUP_MAX)))
+    await asyncio.to_thread(indice_duplicados.cargar, reversed(recientes))
+    del recientes
+    generadores = [asyncio.create_task(generador_lotes(i)) for i in range(GEN_CONCURRENCIA)]
+    ultima_limpieza = 0.0
     try:
-        pregunta = await loop.run_in_executor(None, lambda: pregunta_cache.get(timeout=10))
-        if not es_pregunta_valida(pregunta):
-            return generar_pregunta(tematicas_previas)
-        return pregunta
-    except Exception:
-        pregunta = generar_pregunta(tematicas_previas)
-        return pregunta
+        while True:
+            try:
+                # Devuelve al pool las reservas vencidas o de workers caídos
+                if time.monotonic() - ultima_limpieza > 30:
+                    await asyncio.to_thread(banco.liberar_reservas)
+                    await asyncio.to_thread(banco.liberar_reservas_huerfanas)
+                    ultima_limpieza = time.monotonic()
+                await planificador.muestrear()
+            except Exception:
+                pass
+            planificador.evento_consumo.clear()
+            try:
+                await asyncio.wait_for(planificador.evento_consumo.wait(), timeout=planificador.proxima_espera())
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        for generador in generadores:
+            generador.cancel()
+        await asyncio.gather(*generadores, return_exceptions=True)
+
+async def generador_lotes(indice):
+    """
+    Generador concurrente: cuando el planificador lo habilita pide un lote a Gemini y lo persiste en bloque.
+    """
+    while True:
+        cantidad, tema = await planificador.esperar_trabajo(indice)
+        persistidas = []
+        try:
+            lote = await generar_lote_preguntas(cantidad, tema)
+            # Descarta las preguntas repetidas antes de verificarlas y ocupar lugar en el banco
+            lote = indice_duplicados.filtrar(lote)
+            # Ejecuta cada código y descarta o corrige las respuestas que no coinciden con la salida real
+            lote = await verificador.verificar_lote(lote)
+            if lote:
+                # Arma el HTML de cada pregunta antes de guardarla, fuera del event loop
+                await asyncio.to_thread(prerenderizar_lote, lote)
+                # Persiste en bloque (también si la tarea se cancela durante la escritura)
+                await asyncio.shield(asyncio.to_thread(banco.agregar_lote, lote))
+                # Solo se indexan las que se guardaron: una descartada por la verificación puede volver corregida
+                indice_duplicados.registrar(lote)
+                persistidas = lote
+                ritmo_generacion.registrar(len(lote))
+        except asyncio.CancelledError:
+            raise
+        except CircuitoAbierto:
+            # Espera a que el circuito pase a semiabierto en lugar de reintentar
+            await asyncio.sleep(max(1.0, circuito_gemini.segundos_para_reintento()))
+        except Exception:
+            # Los errores de cuota ya aplicaron backoff en el limitador
+            await asyncio.sleep(1)
+        finally:
+            await asyncio.shield(planificador.lote_terminado(tema, cantidad, persistidas))
 
 # =============================
-# VARIABLE GLOBAL PARA TEMÁTICAS PREVIAS DEL HILO DE PRECARGA
+# REGISTRO DE INTENTOS
 # =============================
-tematicas_previas_global = []
-tematicas_lock = threading.Lock()
+# Historial de respuestas (solo se agregan filas) para analizar preguntas con mala clave
+# o demasiado difíciles. quiz_post solo encola; un escritor de fondo guarda en lotes.
+INTENTOS_COLA = int(os.getenv("INTENTOS_COLA", "10000"))  # Intentos pendientes de escribir por worker
+INTENTOS_LOTE = int(os.getenv("INTENTOS_LOTE", "500"))  # Máximo de filas por transacción
+INTENTOS_INTERVALO = float(os.getenv("INTENTOS_INTERVALO", "1"))  # Segundos que se acumulan antes de escribir
+
+class RegistroIntentos(ConexionesSQLite):
+    """
+    Tabla de intentos: sesión, pregunta, respuesta elegida, si fue correcta y segundos que tardó.
+    """
+    COLUMNAS = ("id", "momento", "sesion", "pregunta_id", "respuesta", "correcta", "segundos")
+
+    def __init__(self, ruta):
+        super().__init__(ruta)
+        self._conexion().executescript(
+            """
+            CREATE TABLE IF NOT EXISTS intentos (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                momento REAL NOT NULL,
+                sesion TEXT,
+                pregunta_id INTEGER,
+                respuesta TEXT,
+                correcta INTEGER NOT NULL,
+                segundos REAL
+            );
+            CREATE INDEX IF NOT EXISTS idx_intentos_pregunta ON intentos(pregunta_id);
+            """
+        )
+
+    def agregar_lote(self, filas):
+        con = self._conexion()
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            con.executemany(
+                "INSERT INTO intentos (momento, sesion, pregunta_id, respuesta, correcta, segundos) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                filas
+            )
+            con.execute("COMMIT")
+        except Exception:
+            con.execute("ROLLBACK")
+            raise
+
+    def leer_desde(self, ultimo_id, limite):
+        """
+        Próximas 'limite' filas con id mayor a 'ultimo_id' (paginación por clave, sin OFFSET).
+        """
+        return self._conexion().execute(
+            f"SELECT {', '.join(self.COLUMNAS)} FROM intentos WHERE id > ? ORDER BY id LIMIT ?",
+            (ultimo_id, limite)
+        ).fetchall()
+
+registro_intentos = RegistroIntentos(DB_PATH)
+cola_intentos = asyncio.Queue(maxsize=INTENTOS_COLA)
+
+def registrar_intento(session, pregunta, respuesta, correcta):
+    """
+    Encola el intento sin esperar; si la cola está llena se descarta (nunca frena al usuario).
+    """
+    ahora = time.time()
+    segundos = ahora - session.get('ultima_respuesta', session.get('inicio', ahora))
+    fila = (ahora, session.get('sid'), pregunta.get('id'), respuesta, int(correcta), round(segundos, 3))
+    try:
+        cola_intentos.put_nowait(fila)
+        m_intentos.labels("registrado").inc()
+    except asyncio.QueueFull:
+        m_intentos.labels("descartado").inc()
+    session['ultima_respuesta'] = ahora
+
+async def escribir_intentos_pendientes():
+    """
+    Escribe hasta INTENTOS_LOTE intentos de la cola. Si la escritura falla (p. ej. 'database is
+    locked') los devuelve a la cola, cuenta como descartados los que ya no entran, y relanza.
+    """
+    filas = []
+    while not cola_intentos.empty() and len(filas) < INTENTOS_LOTE:
+        filas.append(cola_intentos.get_nowait())
+    if filas:
+        try:
+            await asyncio.shield(asyncio.to_thread(registro_intentos.agregar_lote, filas))
+        except Exception:
+            for fila in filas:
+                try:
+                    cola_intentos.put_nowait(fila)
+                except asyncio.QueueFull:
+                    m_intentos.labels("descartado").inc()
+            raise
+    return len(filas)
+
+async def escritor_intentos():
+    """
+    Tarea de fondo: espera el primer intento, deja acumular unos instantes y escribe en lote.
+    """
+    while True:
+        fila = await cola_intentos.get()
+        # Vuelve a la cola para que el vaciado final la incluya si la tarea se cancela durante la espera
+        cola_intentos.put_nowait(fila)
+        await asyncio.sleep(INTENTOS_INTERVALO)
+        try:
+            while await escribir_intentos_pendientes() == INTENTOS_LOTE:
+                pass
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            await asyncio.sleep(1)
 
 # =============================
-# HILO DE PRECARGA DE PREGUNTAS
+# COORDINACIÓN ENTRE WORKERS
 # =============================
-def precargar_preguntas():
+LOCK_PATH = DB_PATH + ".lock"
+_lock_productor = None
+
+def intentar_ser_productor():
+    """
+    Intenta tomar el lock de archivo que designa al único productor entre workers.
+    El lock lo libera el sistema operativo si el proceso muere, y otro worker lo toma.
+    """
+    global _lock_productor
+    if _lock_productor is not None:
+        return True
+    if fcntl is None:
+        _lock_productor = True
+        return True
+    archivo = open(LOCK_PATH, "a")
+    try:
+        fcntl.flock(archivo.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        archivo.close()
+        return False
+    _lock_productor = archivo
+    return True
+
+def liberar_productor():
+    """
+    Suelta el lock de productor para que otro worker pueda tomarlo.
+    """
+    global _lock_productor
+    if _lock_productor is not None and _lock_productor is not True:
+        _lock_productor.close()
+    _lock_productor = None
+
+async def coordinar_productor():
+    """
+    Tarea de cada worker: espera a ganar el lock de productor y entonces ejecuta la precarga.
     """
-    Hilo en segundo plano que mantiene el cache de preguntas lleno.
-    Solo consulta la API si el cache baja del umbral.
-    Usa una variable global protegida por lock para tematicas_previas.
+    while not intentar_ser_productor():
+        await asyncio.sleep(5)
+    # Reemplaza lo que haya publicado un productor anterior (que pudo caer con el circuito abierto)
+    await circuito_gemini.publicar(forzar=True)
+    await precargar_preguntas()
+
+# Muestras (instante, cache local, disponibles en el banco) cada 10 segundos, durante una hora
+historial_profundidad = deque(maxlen=360)
+
+async def reponer_cache_local():
     """
-    global tematicas_previas_global
+    Tarea de cada worker: reserva preguntas del banco compartido cuando su cache
+    en memoria baja de la mitad. Duerme hasta que un consumo la despierte o,
+    como máximo, unos segundos para recoger lo que el productor haya generado.
+    """
+    ultima_muestra = 0.0
     while True:
-        if pregunta_cache.qsize() < CACHE_MIN:
-            try:
-                with tematicas_lock:
-                    tematicas_previas = list(tematicas_previas_global)
-                pregunta = generar_pregunta(tematicas_previas)
-                # Solo la guarda si es válida
-                if es_pregunta_valida(pregunta):
-                    pregunta_cache.put(pregunta)
-                    # Actualiza la variable global de tematicas_previas
-                    with tematicas_lock:
-                        tematicas_previas_global = pregunta.get("tematicas_usadas", [])
-                time.sleep(5)  # Espera 5 segundos antes de volver a intentar
-            except Exception as e:
-                # Si es un error de cuota, espera más tiempo
-                if "RESOURCE_EXHAUSTED" in str(e):
-                    time.sleep(35)
-                else:
-                    time.sleep(5)
-        else:
-            time.sleep(2)  # Espera antes de volver a chequear
+        try:
+            if pregunta_cache.qsize() < CACHE_LOCAL // 2:
+                await cargar_cache_desde_banco()
+        except Exception:
+            pass
+        try:
+            # Mantiene al día el estado del circuito que ven /metrics y las rutas de este worker
+            await circuito_gemini.actualizar_compartido()
+        except Exception:
+            pass
+        if time.monotonic() - ultima_muestra >= 10:
+            historial_profundidad.append((int(time.time()), pregunta_cache.qsize(), planificador.disponibles))
+            ultima_muestra = time.monotonic()
+        evento_reponer.clear()
+        try:
+            await asyncio.wait_for(evento_reponer.wait(), timeout=2)
+        except asyncio.TimeoutError:
+            pass
+
+# =============================
+# ARRANQUE Y DISPONIBILIDAD DEL WORKER
+# =============================
+# El worker arranca al instante: el calentamiento corre de fondo y /listo informa
+# cuándo el cache local alcanzó el mínimo (o venció la espera máxima, ya que
+# el generador local siempre puede responder).
+LISTO_MINIMO = int(os.getenv("LISTO_MINIMO", str(min(5, CACHE_LOCAL))))  # Preguntas en cache para estar listo
+LISTO_ESPERA_MAX = float(os.getenv("LISTO_ESPERA_MAX", "30"))  # Segundos tras los que se declara listo igual
+
+arranque = {'inicio': None, 'calentado': False, 'listo': False}
+# Tareas de fondo del proceso; evita lanzarlas dos veces si el lifespan se vuelve a ejecutar
+_tareas_fondo = []
 
-# Inicia el hilo de precarga al arrancar la app
-threading.Thread(target=precargar_preguntas, daemon=True).start()
+def crear_primitivas_asincronas():
+    """
+    Crea los primitivos de asyncio en el event loop que corre la app (los del import
+    podrían haber quedado ligados al loop de una ejecución anterior).
+    """
+    global evento_reponer, semaforo_gemini, cola_intentos
+    evento_reponer = asyncio.Event()
+    semaforo_gemini = asyncio.Semaphore(GEN_CONCURRENCIA)
+    pendientes = []
+    while not cola_intentos.empty():
+        pendientes.append(cola_intentos.get_nowait())
+    cola_intentos = asyncio.Queue(maxsize=INTENTOS_COLA)
+    for fila in pendientes:
+        cola_intentos.put_nowait(fila)
+    limitador_gemini._lock = asyncio.Lock()
+    planificador.condicion = asyncio.Condition()
+    planificador.evento_consumo = asyncio.Event()
+    verificador.semaforo = asyncio.Semaphore(VERIF_CONCURRENCIA)
+
+async def calentar_worker():
+    """
+    Primero carga en el cache las preguntas ya persistidas; recién después arranca
+    la reposición y la coordinación del productor (que llama a Gemini).
+    """
+    try:
+        await cargar_cache_desde_banco()
+    except Exception:
+        pass
+    arranque['calentado'] = True
+    await asyncio.gather(coordinar_productor(), reponer_cache_local())
+
+def worker_listo():
+    """
+    True cuando terminó el calentamiento y el cache llegó a LISTO_MINIMO (o pasó LISTO_ESPERA_MAX).
+    Una vez listo no vuelve atrás: un cache vacío bajo carga se cubre con el respaldo local.
+    """
+    if not arranque['listo'] and arranque['calentado']:
+        esperado = arranque['inicio'] is not None and time.monotonic() - arranque['inicio'] >= LISTO_ESPERA_MAX
+        if pregunta_cache.qsize() >= LISTO_MINIMO or esperado:
+            arranque['listo'] = True
+    return arranque['listo']
+
+@asynccontextmanager
+async def lifespan(app):
+    """
+    Arranca las tareas de fondo del worker al iniciar la app y las cancela al apagarla.
+    """
+    if _tareas_fondo:
+        # Ya corren en este proceso (lifespan anidado o repetido): no se duplican
+        yield
+        return
+    crear_primitivas_asincronas()
+    arranque.update(inicio=time.monotonic(), calentado=False, listo=False)
+    _tareas_fondo.extend([
+        asyncio.create_task(calentar_worker()),
+        asyncio.create_task(escritor_intentos()),
+    ])
+    try:
+        yield
+    finally:
+        tareas = list(_tareas_fondo)
+        _tareas_fondo.clear()
+        for tarea in tareas:
+            tarea.cancel()
+        await asyncio.gather(*tareas, return_exceptions=True)
+        # Guarda los intentos que quedaron en la cola; si el banco sigue fallando se cuentan como perdidos
+        try:
+            while await escribir_intentos_pendientes():
+                pass
+        except Exception:
+            m_intentos.labels("descartado").inc(cola_intentos.qsize())
+        liberar_productor()
 
 # =============================
 # FASTAPI APP Y RUTAS
 # =============================
 
 # Inicialización de la app y sistema de plantillas
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
+
+@app.middleware("http")
+async def medir_peticiones(request: Request, call_next):
+    """
+    Registra la duración de cada petición en el histograma de su ruta.
+    """
+    inicio = time.perf_counter()
+    response = await call_next(request)
+    ruta = request.scope.get("route")
+    m_peticiones.labels(ruta.path if ruta else "desconocida", request.method).observe(time.perf_counter() - inicio)
+    return response
 templates_path = os.path.join(os.path.dirname(__file__), 'templates')
 templates = Jinja2Templates(directory=templates_path)
+# Las plantillas compiladas quedan en memoria; solo se vuelven a leer del disco en desarrollo
+templates.env.auto_reload = os.getenv("TEMPLATES_RECARGA", "0") == "1"
+
+# =============================
+# HTML PRE-RENDERIZADO
+# =============================
+# El fragmento de cada pregunta (código resaltado, respuestas escapadas) se arma una
+# sola vez al entrar al banco y viaja con la pregunta; quiz.html solo lo inserta.
+_plantilla_fragmento = templates.env.get_template('_pregunta.html')
+# Cambia cuando cambia _pregunta.html, para rehacer los fragmentos ya guardados en el banco
+VERSION_HTML = 2
+
+# Estilos en línea por tipo de token (quiz.html no necesita CSS extra)
+_ESTILOS_TOKEN = {
+    "palabra_clave": "color:#008000;font-weight:bold",
+    "builtin": "color:#008000",
+    "cadena": "color:#BA2121",
+    "numero": "color:#666666",
+    "operador": "color:#666666",
+    "comentario": "color:#3D7B7B;font-style:italic",
+}
+_TOKENS_CADENA = {tokenize.STRING} | {
+    getattr(tokenize, nombre) for nombre in ("FSTRING_START", "FSTRING_MIDDLE", "FSTRING_END") if hasattr(tokenize, nombre)
+}
+_BUILTINS = frozenset(dir(builtins))
+
+def _clase_token(tok):
+    if tok.type == tokenize.NAME:
+        if keyword.iskeyword(tok.string):
+            return "palabra_clave"
+        return "builtin" if tok.string in _BUILTINS else None
+    if tok.type in _TOKENS_CADENA:
+        return "cadena"
+    if tok.type == tokenize.NUMBER:
+        return "numero"
+    if tok.type == tokenize.OP:
+        return "operador"
+    if tok.type == tokenize.COMMENT:
+        return "comentario"
+    return None
+
+def resaltar_codigo(codigo):
+    """
+    Devuelve el código como HTML escapado y resaltado con el tokenizador de Python
+    (si no tokeniza, solo escapado).
+    """
+    inicios = [0]
+    for linea in io.StringIO(codigo).readlines():  # Mismo corte de líneas que el tokenizador
+        inicios.append(inicios[-1] + len(linea))
+    partes = []
+    posicion = 0
+    try:
+        for tok in tokenize.generate_tokens(io.StringIO(codigo).readline):
+            clase = _clase_token(tok)
+            if clase is None:
+                continue
+            desde = inicios[tok.start[0] - 1] + tok.start[1]
+            hasta = inicios[tok.end[0] - 1] + tok.end[1]
+            partes.append(str(escape(codigo[posicion:desde])))
+            partes.append(f'<span style="{_ESTILOS_TOKEN[clase]}">{escape(codigo[desde:hasta])}</span>')
+            posicion = hasta
+    except (tokenize.TokenError, IndentationError, SyntaxError):
+        return str(escape(codigo))
+    partes.append(str(escape(codigo[posicion:])))
+    return "".join(partes)
+
+def prerenderizar_pregunta(pregunta):
+    """
+    Arma el HTML de la pregunta y lo guarda en la propia pregunta (clave 'html').
+    """
+    pregunta["html"] = {
+        "version": VERSION_HTML,
+        "enunciado": str(escape(pregunta["pregunta"])),
+        "cuerpo": _plantilla_fragmento.render(pregunta=pregunta, codigo_html=resaltar_codigo(pregunta["codigo"])),
+    }
+    return pregunta
+
+def prerenderizar_lote(preguntas):
+    for pregunta in preguntas:
+        prerenderizar_pregunta(pregunta)
+    return preguntas
+
+def fragmento_pregunta(pregunta):
+    """
+    HTML de la pregunta; las guardadas antes del pre-renderizado (o con otra versión del
+    fragmento) se arman la primera vez que se muestran.
+    """
+    if pregunta.get("html", {}).get("version") != VERSION_HTML:
+        prerenderizar_pregunta(pregunta)
+    return pregunta["html"]
+
+# Páginas estáticas (sin datos del estudiante): se renderizan y comprimen una sola vez y el
+# navegador las revalida por ETag. Solo se usa desde rutas async, es decir, siempre en el hilo
+# del event loop, así que el LRUCache no necesita lock; la clave incluye base_url porque las
+# plantillas arman URLs absolutas con url_for.
+paginas_cache = LRUCache(maxsize=int(os.getenv("PAGINAS_CACHE", 16)))
+
+def pagina_cacheada(request: Request, nombre):
+    """
+    Devuelve la plantilla estática renderizada desde el cache (comprimida con gzip si el
+    navegador lo acepta), o 304 si el navegador ya tiene esa versión.
+    Llamar solo desde rutas async.
+    """
+    clave = (nombre, str(request.base_url))
+    pagina = paginas_cache.get(clave)
+    if pagina is None:
+        cuerpo = templates.get_template(nombre).render({'request': request}).encode()
+        etag = '"' + hashlib.blake2b(cuerpo, digest_size=8).hexdigest() + '"'
+        pagina = paginas_cache[clave] = (cuerpo, gzip.compress(cuerpo), etag)
+    cuerpo, comprimido, etag = pagina
+    cabeceras = {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=cabeceras)
+    if "gzip" in request.headers.get("accept-encoding", ""):
+        cabeceras["Content-Encoding"] = "gzip"
+        return HTMLResponse(comprimido, headers=cabeceras)
+    return HTMLResponse(cuerpo, headers=cabeceras)
 
 # Configuración de la clave secreta y serializador para cookies firmadas
 SECRET_KEY = os.getenv("SESSION_SECRET_KEY")
@@ -281,42 +2585,271 @@ if not SECRET_KEY:
         "Establezca un valor seguro en su entorno o archivo .env."
     )
 SESSION_COOKIE = "quiz_session"
+SESSION_TTL = 60*60*60
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "sqlite")  # "sqlite" (compartido entre workers) o "memoria"
+# Solo detecta WEB_CONCURRENCY (gunicorn, variable de entorno de uvicorn); 'uvicorn --workers N' no
+# la define, así que con ese flag el backend en memoria arranca igual y cada worker tiene sus sesiones.
+if SESSION_BACKEND == "memoria" and int(os.getenv("WEB_CONCURRENCY", "1")) > 1:
+    raise RuntimeError(
+        "SESSION_BACKEND=memoria no funciona con varios workers (WEB_CONCURRENCY > 1): "
+        "cada worker tendría sus propias sesiones. Use SESSION_BACKEND=sqlite "
+        "(tampoco sirve con 'uvicorn --workers N', aunque ese flag no se detecta aquí)."
+    )
 serializer = URLSafeSerializer(SECRET_KEY)
 
-def get_session(request: Request):
+# =============================
+# SESIONES EN EL SERVIDOR
+# =============================
+# La cookie solo lleva un id de sesión firmado; los datos quedan en el servidor
+# y la pregunta actual se guarda por id (nunca viaja la respuesta correcta).
+class AlmacenSesionesMemoria:
+    """
+    Sesiones en un LRU en memoria del proceso con expiración por TTL.
+    """
+    def __init__(self, maximo, ttl):
+        self._sesiones = TTLCache(maxsize=maximo, ttl=ttl)
+
+    async def obtener(self, sid):
+        datos = self._sesiones.get(sid)
+        return dict(datos) if datos is not None else None
+
+    async def guardar(self, sid, datos):
+        self._sesiones[sid] = dict(datos)
+
+    async def borrar(self, sid):
+        self._sesiones.pop(sid, None)
+
+class AlmacenSesionesSQLite(ConexionesSQLite):
+    """
+    Sesiones en SQLite, compartidas por todos los workers; las vencidas se purgan periódicamente.
+    """
+    def __init__(self, ruta, ttl):
+        super().__init__(ruta)
+        self.ttl = ttl
+        self._escrituras = 0
+        self._conexion().execute(
+            "CREATE TABLE IF NOT EXISTS sesiones (id TEXT PRIMARY KEY, datos TEXT NOT NULL, expira REAL NOT NULL)"
+        )
+
+    def _obtener(self, sid):
+        fila = self._conexion().execute(
+            "SELECT datos FROM sesiones WHERE id = ? AND expira > ?", (sid, time.time())
+        ).fetchone()
+        return json.loads(fila[0]) if fila else None
+
+    def _guardar(self, sid, datos):
+        con = self._conexion()
+        con.execute(
+            "INSERT OR REPLACE INTO sesiones (id, datos, expira) VALUES (?, ?, ?)",
+            (sid, json.dumps(datos, ensure_ascii=False), time.time() + self.ttl)
+        )
+        self._escrituras += 1
+        if self._escrituras % 1000 == 0:
+            con.execute("DELETE FROM sesiones WHERE expira <= ?", (time.time(),))
+
+    def _borrar(self, sid):
+        self._conexion().execute("DELETE FROM sesiones WHERE id = ?", (sid,))
+
+    async def obtener(self, sid):
+        return await asyncio.to_thread(self._obtener, sid)
+
+    async def guardar(self, sid, datos):
+        await asyncio.to_thread(self._guardar, sid, datos)
+
+    async def borrar(self, sid):
+        await asyncio.to_thread(self._borrar, sid)
+
+if SESSION_BACKEND == "sqlite":
+    almacen_sesiones = AlmacenSesionesSQLite(DB_PATH, SESSION_TTL)
+else:
+    almacen_sesiones = AlmacenSesionesMemoria(int(os.getenv("SESSION_MAX", "10000")), SESSION_TTL)
+
+def leer_sid(request: Request):
     """
-    Recupera y valida la sesión del usuario desde la cookie.
-    Si no existe o la firma es inválida, devuelve un dict vacío.
+    Devuelve el id de sesión de la cookie si la firma es válida, o None.
+    Las cookies del formato anterior (la sesión entera como dict, firmada con la misma clave)
+    también validan la firma: se tratan como sesión inexistente.
     """
     cookie = request.cookies.get(SESSION_COOKIE)
     if not cookie:
-        return {}
+        return None
     try:
-        return serializer.loads(cookie)
+        sid = serializer.loads(cookie)
     except BadSignature:
-        return {}
+        return None
+    return sid if isinstance(sid, str) else None
+
+async def get_session(request: Request):
+    """
+    Recupera la sesión del usuario a partir del id firmado de la cookie.
+    Resuelve la pregunta actual por su id. Si no existe, devuelve un dict vacío.
+    """
+    with cronometro(m_sesion.labels("leer")):
+        sid = leer_sid(request)
+        if not sid:
+            return {}
+        datos = await almacen_sesiones.obtener(sid)
+        if not datos:
+            return {}
+        datos['sid'] = sid
+        id_pregunta = datos.pop('pregunta_id', None)
+        if id_pregunta is not None:
+            datos['pregunta_actual'] = await cargar_pregunta(id_pregunta)
+        return datos
 
-def set_session(response: Response, session_data: dict):
+async def set_session(response: Response, session_data: dict):
     """
-    Serializa y firma los datos de sesión, y los guarda en la cookie de la respuesta.
+    Guarda los datos de sesión en el servidor (la pregunta actual solo por id)
+    y deja en la cookie únicamente el id de sesión firmado.
     """
-    cookie_value = serializer.dumps(session_data)
-    response.set_cookie(SESSION_COOKIE, cookie_value, httponly=True, max_age=60*60*60)
+    with cronometro(m_sesion.labels("guardar")):
+        sid = session_data.get('sid') or secrets.token_urlsafe(16)
+        datos = {k: v for k, v in session_data.items() if k not in ('sid', 'pregunta_actual')}
+        pregunta = session_data.get('pregunta_actual')
+        if isinstance(pregunta, dict) and 'id' in pregunta:
+            datos['pregunta_id'] = pregunta['id']
+        # Temáticas ya mostradas, para que las siguientes preguntas de la sesión sean de otras
+        if isinstance(pregunta, dict) and pregunta.get('tema'):
+            vistos = datos.get('temas_vistos', [])
+            if pregunta['tema'] not in vistos:
+                datos['temas_vistos'] = vistos + [pregunta['tema']]
+        await almacen_sesiones.guardar(sid, datos)
+        response.set_cookie(SESSION_COOKIE, serializer.dumps(sid), httponly=True, max_age=SESSION_TTL)
 
-def clear_session(response: Response):
+async def clear_session(response: Response, session_data: dict = None):
     """
-    Elimina la cookie de sesión.
+    Elimina la cookie de sesión y, si se indica, los datos guardados en el servidor.
     """
+    if session_data and session_data.get('sid'):
+        await almacen_sesiones.borrar(session_data['sid'])
     response.delete_cookie(SESSION_COOKIE)
 
+# =============================
+# MODO EXAMEN
+# =============================
+# Con MODO_EXAMEN=1 cada sesión recibe al empezar un juego completo de preguntas de
+# temáticas distintas; el resto del examen no depende del cache ni del generador.
+# Los juegos de una cohorte pueden armarse de antemano con POST /admin/examen.
+MODO_EXAMEN = os.getenv("MODO_EXAMEN", "0") == "1"
+PREGUNTAS_EXAMEN = 10
+EXAMEN_MAX_JUEGOS = int(os.getenv("EXAMEN_MAX_JUEGOS", "500"))  # Juegos por llamada al endpoint de administración
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")  # Sin token el endpoint de administración queda deshabilitado
+
+class JuegosExamen(ConexionesSQLite):
+    """
+    Juegos de examen armados de antemano (lista de ids de preguntas), asignados uno por sesión.
+    """
+    def __init__(self, ruta):
+        super().__init__(ruta)
+        self._conexion().execute(
+            """
+            CREATE TABLE IF NOT EXISTS juegos_examen (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                preguntas TEXT NOT NULL,
+                creado REAL NOT NULL,
+                asignado REAL
+            )
+            """
+        )
+
+    def agregar(self, juegos):
+        con = self._conexion()
+        ahora = time.time()
+        con.executemany(
+            "INSERT INTO juegos_examen (preguntas, creado) VALUES (?, ?)",
+            [(json.dumps(ids), ahora) for ids in juegos]
+        )
+
+    def asignar(self):
+        """
+        Asigna el juego libre más antiguo y devuelve sus ids, o None si no quedan.
+        """
+        fila = self._conexion().execute(
+            """
+            UPDATE juegos_examen SET asignado = ?
+            WHERE id = (SELECT id FROM juegos_examen WHERE asignado IS NULL ORDER BY id LIMIT 1)
+            RETURNING preguntas
+            """,
+            (time.time(),)
+        ).fetchone()
+        return json.loads(fila[0]) if fila else None
+
+    def contar_disponibles(self):
+        return self._conexion().execute(
+            "SELECT COUNT(*) FROM juegos_examen WHERE asignado IS NULL"
+        ).fetchone()[0]
+
+juegos_examen = JuegosExamen(DB_PATH)
+
+def armar_juego():
+    """
+    Arma un juego de examen con preguntas del banco tomadas en bloque; si el banco no alcanza,
+    lo completa con el generador local (temáticas que el juego todavía no tiene).
+    """
+    preguntas = banco.tomar_juego(PREGUNTAS_EXAMEN)
+    temas = {pregunta.get("tema") for pregunta in preguntas}
+    locales = []
+    for _ in range(PREGUNTAS_EXAMEN - len(preguntas)):
+        pregunta = generar_pregunta_local(excluir=temas)
+        temas.add(pregunta["tema"])
+        locales.append(pregunta)
+    if locales:
+        banco.agregar_lote(prerenderizar_lote(locales), servida=True)
+    preguntas += locales
+    random.shuffle(preguntas)
+    return preguntas
+
+def provisionar_juegos(cantidad):
+    """
+    Arma 'cantidad' juegos y los guarda para asignarlos luego. Devuelve cuántas preguntas fueron locales.
+    """
+    juegos = []
+    locales = 0
+    for _ in range(cantidad):
+        preguntas = armar_juego()
+        locales += sum(1 for pregunta in preguntas if pregunta.get("origen") == "local")
+        juegos.append([pregunta["id"] for pregunta in preguntas])
+    juegos_examen.agregar(juegos)
+    return locales
+
+async def iniciar_juego():
+    """
+    Devuelve los ids del juego de examen de una sesión nueva: uno armado de antemano si queda,
+    si no, uno armado en el momento.
+    """
+    ids = await asyncio.to_thread(juegos_examen.asignar)
+    if ids:
+        return ids
+    preguntas = await asyncio.to_thread(armar_juego)
+    for pregunta in preguntas:
+        recordar_pregunta(pregunta)
+    return [pregunta["id"] for pregunta in preguntas]
+
+async def siguiente_pregunta(session):
+    """
+    Próxima pregunta de la sesión: la siguiente de su juego de examen si tiene uno;
+    si no, del cache (de una temática todavía no vista).
+    Deja en session['juego'] una copia sin las preguntas consumidas: con el backend en memoria
+    la lista original es la misma que quedó guardada en el almacén.
+    """
+    juego = session.get('juego')
+    if juego:
+        juego = session['juego'] = list(juego)
+    while juego:
+        pregunta = await cargar_pregunta(juego.pop(0))
+        if es_pregunta_valida(pregunta):
+            return pregunta
+    return await obtener_pregunta_cache_async(session.get('temas_vistos', []))
+
 @app.get('/', name="inicio")
-def inicio(request: Request):
+async def inicio(request: Request):
     """
     Ruta de inicio: muestra la presentación y botón para comenzar el quiz.
     Limpia cualquier sesión previa.
     """
-    response = templates.TemplateResponse('inicio.html', {'request': request})
-    clear_session(response)
+    response = pagina_cacheada(request, 'inicio.html')
+    sid = leer_sid(request)
+    await clear_session(response, {'sid': sid} if sid else None)
     return response
 
 @app.get("/quiz", name="quiz")
@@ -325,15 +2858,19 @@ async def quiz_get(request: Request):
     Muestra la pregunta actual.
     Si la sesión no existe o está incompleta, la inicializa.
     """
-    session = get_session(request)
+    session = await get_session(request)
 
     if not all(k in session for k in ['puntaje', 'total', 'inicio', 'pregunta_actual']) or session == {}:
-        nueva_pregunta = await obtener_pregunta_cache_async()
+        juego = await iniciar_juego() if MODO_EXAMEN else []
+        inicial = {'juego': juego}
+        nueva_pregunta = await siguiente_pregunta(inicial)
+        juego = inicial['juego']
         intentos = 0
         while not es_pregunta_valida(nueva_pregunta) and intentos < 10:
             await asyncio.sleep(2)
             nueva_pregunta = await obtener_pregunta_cache_async()
             intentos += 1
+            m_reintentos.labels("quiz_get").inc()
         if not es_pregunta_valida(nueva_pregunta):
             response = RedirectResponse(
                 url=f'/error?detalle=Límite%20de%20intentos%20superado&texto=No%20se%20pudo%20generar%20una%20pregunta%20válida.%20Por%20favor%20intente%20nuevamente%20más%20tarde.',
@@ -345,15 +2882,17 @@ async def quiz_get(request: Request):
             'total': 0,
             'inicio': int(time.time()),
             'pregunta_actual': nueva_pregunta,
-            'errores': []
+            'errores': [],
+            'juego': juego
         }
 
     # Si la pregunta actual no es válida, reintenta obtener otra
     intentos = 0
     while not es_pregunta_valida(session['pregunta_actual']) and intentos < 10:
         await asyncio.sleep(2)
-        session['pregunta_actual'] = await obtener_pregunta_cache_async()
+        session['pregunta_actual'] = await obtener_pregunta_cache_async(session.get('temas_vistos', []))
         intentos += 1
+        m_reintentos.labels("quiz_get").inc()
     if not es_pregunta_valida(session['pregunta_actual']):
         response = RedirectResponse(
             url=f'/error?detalle=Límite%20de%20intentos%20superado&texto=No%20se%20pudo%20generar%20una%20pregunta%20válida.%20Por%20favor%20intente%20nuevamente%20más%20tarde.',
@@ -365,10 +2904,11 @@ async def quiz_get(request: Request):
     num_pregunta = session.get('total', 0) + 1
     response = templates.TemplateResponse(
         'quiz.html',
-        {'request': request, 'pregunta': pregunta, 'num_pregunta': num_pregunta}
+        {'request': request, 'fragmento': fragmento_pregunta(pregunta), 'num_pregunta': num_pregunta,
+         'error_pendiente': session.pop('error_pendiente', None)}
     )
     
-    set_session(response, session)
+    await set_session(response, session)
     return response
 
 @app.post('/quiz')
@@ -378,7 +2918,7 @@ async def quiz_post(request: Request, respuesta: str = Form(...)):
     Actualiza el puntaje y los errores en la sesión.
     Si se llega a 10 preguntas, redirige a la página de resultados.
     """
-    session = get_session(request)
+    session = await get_session(request)
     if not all(k in session for k in ['puntaje', 'total', 'inicio', 'pregunta_actual']):
         return RedirectResponse(url='/', status_code=303)
 
@@ -386,8 +2926,9 @@ async def quiz_post(request: Request, respuesta: str = Form(...)):
     intentos = 0
     while not es_pregunta_valida(session['pregunta_actual']) and intentos < 10:
         await asyncio.sleep(2)
-        session['pregunta_actual'] = await obtener_pregunta_cache_async()
+        session['pregunta_actual'] = await obtener_pregunta_cache_async(session.get('temas_vistos', []))
         intentos += 1
+        m_reintentos.labels("quiz_post").inc()
     if not es_pregunta_valida(session['pregunta_actual']):
         response = RedirectResponse(
             url=f'/error?detalle=Límite%20de%20intentos%20superado&texto=No%20se%20pudo%20generar%20una%20pregunta%20válida.%20Por%20favor%20intente%20nuevamente%20más%20tarde.',
@@ -400,8 +2941,19 @@ async def quiz_post(request: Request, respuesta: str = Form(...)):
     explicacion = session['pregunta_actual']['explicacion']
     session['total'] += 1
 
-    if seleccion and seleccion.strip() == correcta.strip():
+    acierto = bool(seleccion) and seleccion.strip() == correcta.strip()
+    if acierto:
         session['puntaje'] += 1
+    registrar_intento(session, session['pregunta_actual'], seleccion, acierto)
+    if not acierto:
+        # El detalle del error se entrega en la página siguiente: la clave nunca viaja con la pregunta
+        session['error_pendiente'] = {
+            'pregunta': session['pregunta_actual']['pregunta'],
+            'codigo': session['pregunta_actual']['codigo'],
+            'respuesta_correcta': correcta,
+            'respuesta_usuario': seleccion,
+            'explicacion': explicacion,
+        }
 
     if session['total'] >= 10:
         tiempo = int(time.time() - session['inicio'])
@@ -410,16 +2962,18 @@ async def quiz_post(request: Request, respuesta: str = Form(...)):
             url=f'/resultado?correctas={puntaje}&tiempo={tiempo}',
             status_code=303
         )
-        clear_session(response)
+        # Solo queda el último error, que /resultado entrega antes de borrar la sesión
+        await set_session(response, {'sid': session['sid'], 'error_pendiente': session.get('error_pendiente')})
         return response
 
-    # Si no ha terminado, obtiene una nueva pregunta y actualiza la sesión
-    nueva_pregunta = await obtener_pregunta_cache_async()
+    # Si no ha terminado, obtiene la siguiente pregunta (del juego de examen o del cache) y actualiza la sesión
+    nueva_pregunta = await siguiente_pregunta(session)
     intentos = 0
     while not es_pregunta_valida(nueva_pregunta) and intentos < 10:
         await asyncio.sleep(2)
-        nueva_pregunta = await obtener_pregunta_cache_async()
+        nueva_pregunta = await obtener_pregunta_cache_async(session.get('temas_vistos', []))
         intentos += 1
+        m_reintentos.labels("quiz_post").inc()
     if not es_pregunta_valida(nueva_pregunta):
         response = RedirectResponse(
             url=f'/error?detalle=Límite%20de%20intentos%20superado&texto=No%20se%20pudo%20generar%20una%20pregunta%20válida.%20Por%20favor%20intente%20nuevamente%20más%20tarde.',
@@ -428,20 +2982,23 @@ async def quiz_post(request: Request, respuesta: str = Form(...)):
         return response
     session['pregunta_actual'] = nueva_pregunta
     response = RedirectResponse(url='/quiz', status_code=303)
-    set_session(response, session)
+    await set_session(response, session)
     return response
 
 @app.get('/resultado')
-def resultado(request: Request, correctas: int = 0, tiempo: int = 0):
+async def resultado(request: Request, correctas: int = 0, tiempo: int = 0):
     """
     Ruta para mostrar el resultado final.
-    Recupera los errores desde la cookie temporal y los muestra junto al puntaje y tiempo.
+    Entrega el error de la última respuesta, si lo hubo, y borra la sesión.
     """
+    session = await get_session(request)
     # Recupera errores del localStorage usando JavaScript en resultado.html
     response = templates.TemplateResponse(
         'resultado.html',
-        {'request': request, 'correctas': correctas, 'tiempo': tiempo, 'errores': []}  # errores vacío, se cargan en el frontend
+        {'request': request, 'correctas': correctas, 'tiempo': tiempo, 'errores': [],  # errores vacío, se cargan en el frontend
+         'error_pendiente': session.get('error_pendiente')}
     )
+    await clear_session(response, session or None)
     return response
 
 @app.get('/error')
@@ -453,4 +3010,159 @@ def error(request: Request, detalle: str = '', texto: str = ''):
         'error.html',
         {'request': request, 'detalle': detalle, 'texto': texto},
         status_code=500
-    )
\ No newline at end of file
+    )
+
+def es_admin(request: Request):
+    """
+    Verifica la cabecera X-Admin-Token de los endpoints de administración.
+    """
+    token = request.headers.get('x-admin-token', '')
+    return bool(ADMIN_TOKEN) and secrets.compare_digest(token, ADMIN_TOKEN)
+
+@app.post('/admin/examen')
+async def provisionar_examen(request: Request, juegos: int = 30):
+    """
+    Arma de antemano los juegos de examen de una cohorte (requiere la cabecera X-Admin-Token).
+    """
+    if not es_admin(request):
+        return JSONResponse({'error': 'No autorizado'}, status_code=403)
+    juegos = max(1, min(juegos, EXAMEN_MAX_JUEGOS))
+    locales = await asyncio.to_thread(provisionar_juegos, juegos)
+    return {
+        'juegos_creados': juegos,
+        'preguntas_locales': locales,
+        'juegos_disponibles': await asyncio.to_thread(juegos_examen.contar_disponibles),
+    }
+
+async def exportar_filas(formato, desde):
+    """
+    Genera el historial por bloques de 1000 filas leídas del banco, sin cargarlo entero en memoria.
+    """
+    if formato == 'csv':
+        salida = io.StringIO()
+        escritor = csv.writer(salida)
+        escritor.writerow(RegistroIntentos.COLUMNAS)
+        yield salida.getvalue()
+    ultimo_id = desde
+    while True:
+        filas = await asyncio.to_thread(registro_intentos.leer_desde, ultimo_id, 1000)
+        if not filas:
+            return
+        ultimo_id = filas[-1][0]
+        if formato == 'csv':
+            salida = io.StringIO()
+            csv.writer(salida).writerows(filas)
+            yield salida.getvalue()
+        else:
+            yield "".join(
+                json.dumps(dict(zip(RegistroIntentos.COLUMNAS, fila)), ensure_ascii=False) + "\n" for fila in filas
+            )
+
+@app.get('/admin/intentos')
+async def exportar_intentos(request: Request, formato: str = 'csv', desde: int = 0):
+    """
+    Exporta en streaming el historial de intentos (CSV o NDJSON) a partir del id 'desde'.
+    """
+    if not es_admin(request):
+        return JSONResponse({'error': 'No autorizado'}, status_code=403)
+    if formato not in ('csv', 'ndjson'):
+        return JSONResponse({'error': "Formato inválido: use 'csv' o 'ndjson'"}, status_code=400)
+    tipo = 'text/csv; charset=utf-8' if formato == 'csv' else 'application/x-ndjson'
+    return StreamingResponse(
+        exportar_filas(formato, desde), media_type=tipo,
+        headers={'Content-Disposition': f'attachment; filename="intentos.{formato}"'}
+    )
+
+@app.get('/listo')
+def listo():
+    """
+    Readiness del worker: 200 cuando puede recibir tráfico, 503 mientras se calienta.
+    """
+    datos = {
+        'listo': worker_listo(),
+        'calentado': arranque['calentado'],
+        'cache_local': pregunta_cache.qsize(),
+        'minimo': LISTO_MINIMO,
+    }
+    return JSONResponse(datos, status_code=200 if datos['listo'] else 503)
+
+@app.get('/estado')
+async def estado():
+    """
+    Estado del generador de este worker: ritmo actual y preguntas por minuto producidas.
+    Corre en el event loop (no en el threadpool) para leer las métricas y contadores sin
+    competir con las tareas que los modifican; solo las consultas a SQLite van a un hilo.
+    """
+    await circuito_gemini.actualizar_compartido(antiguedad=0)
+    juegos_disponibles = await asyncio.to_thread(juegos_examen.contar_disponibles)
+    return {
+        'productor': _lock_productor is not None,
+        'cache_local': pregunta_cache.qsize(),
+        'cache_local_por_tema': pregunta_cache.resumen(),
+        'disponibles_por_tema': planificador.disponibles_por_tema,
+        'preguntas_por_minuto': round(ritmo_generacion.por_minuto(), 2),
+        'llamadas_por_minuto_permitidas': round(limitador_gemini.rpm, 2),
+        'backoff_restante': round(max(0.0, limitador_gemini.bloqueado_hasta - time.monotonic()), 2),
+        'circuito_gemini': circuito_gemini.resumen(),
+        'preguntas_en_vuelo': planificador.en_vuelo,
+        'demanda_por_minuto': round(planificador.tasa * 60, 2),
+        'segundos_hasta_vaciar': planificador.segundos_hasta_vaciar(),
+        'objetivo_banco': planificador.objetivo,
+        'disponibles_banco': planificador.disponibles,
+        'generadores_activos': planificador.concurrencia,
+        'consumo_local': planificador.consumo_local,
+        'dedup_evaluadas': indice_duplicados.evaluadas,
+        'dedup_exactas': indice_duplicados.duplicadas_exactas,
+        'dedup_casi_duplicadas': indice_duplicados.casi_duplicadas,
+        'tasa_duplicadas': round(indice_duplicados.tasa_duplicadas(), 4),
+        'verificacion': verificador.estadisticas,
+        'cache': m_cache.resumen(),
+        'modo_examen': MODO_EXAMEN,
+        'juegos_examen_disponibles': juegos_disponibles,
+    }
+
+# Indicadores que se calculan al exponer las métricas
+metricas.registrar(Indicador(
+    "quiz_cache_local", "Preguntas en el cache en memoria del worker", funcion=lambda: pregunta_cache.qsize()))
+metricas.registrar(Indicador(
+    "quiz_banco_disponibles", "Preguntas disponibles en el banco (última muestra del productor)",
+    funcion=lambda: planificador.disponibles))
+metricas.registrar(Indicador(
+    "quiz_productor", "1 si este worker es el productor de preguntas", funcion=lambda: int(_lock_productor is not None)))
+metricas.registrar(Indicador(
+    "quiz_generadores_activos", "Generadores habilitados por el planificador", funcion=lambda: planificador.concurrencia))
+metricas.registrar(Indicador(
+    "quiz_preguntas_en_vuelo", "Preguntas pedidas a Gemini sin respuesta aún", funcion=lambda: planificador.en_vuelo))
+metricas.registrar(Indicador(
+    "quiz_demanda_por_minuto", "Consumo estimado (EWMA) de preguntas por minuto", funcion=lambda: planificador.tasa * 60))
+metricas.registrar(Indicador(
+    "quiz_generacion_por_minuto", "Preguntas generadas en el último minuto", funcion=lambda: ritmo_generacion.por_minuto()))
+metricas.registrar(Indicador(
+    "quiz_gemini_rpm_permitido", "Llamadas por minuto que permite el limitador adaptativo",
+    funcion=lambda: limitador_gemini.rpm))
+metricas.registrar(Indicador(
+    "quiz_circuito_gemini", "Estado del circuito de Gemini (0 cerrado, 1 semiabierto, 2 abierto)",
+    funcion=lambda: {"cerrado": 0, "semiabierto": 1, "abierto": 2}[circuito_gemini.compartido["estado"]]))
+
+DEBUG_STATS = os.getenv("DEBUG_STATS", "0") == "1"
+
+@app.get('/metrics')
+async def metrics():
+    """
+    Métricas del worker en formato de texto de Prometheus.
+    """
+    return PlainTextResponse(metricas.texto_prometheus(), media_type="text/plain; version=0.0.4")
+
+@app.get('/debug/stats')
+async def debug_stats():
+    """
+    Resumen en JSON de las métricas (con p50/p95/p99) y la profundidad del cache en el tiempo.
+    Solo disponible con DEBUG_STATS=1.
+    """
+    if not DEBUG_STATS:
+        return JSONResponse({'detalle': 'No disponible'}, status_code=404)
+    return {
+        'metricas': metricas.resumen(),
+        'estado': await estado(),
+        'historial_profundidad': list(historial_profundidad),
+    }